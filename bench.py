@@ -0,0 +1,813 @@
+"""Offline benchmark and load test for bot.py.
+
+Runs the real Application, handlers and per-chat update processor against
+in-process stand-ins for Telegram, Supabase (PostgREST), Gemini and wttr.in,
+so numbers don't depend on the network or API quotas.
+
+    python bench.py chats --chats 1 2 4 8 16 --requests 5
+    python bench.py --save base.json mix --concurrency 1 8 32 --closet 60 500
+    python bench.py --compare base.json mix --concurrency 1 8 32 --closet 60 500
+    python bench.py startup --runs 5
+
+mix drives /outfit, free-text messages, /closet, the /bulk flow,
+/dirty, /clean, /lost and whole-closet laundry (/clean all, "laundry done");
+trip plans are available too, outside the default mix. --save keeps the
+results (with the commit they came from); --compare reruns and exits 1 if any p95 or updates/s regressed by
+more than --tolerance, which is how to check one commit against another.
+
+--llm-tail/--llm-tail-latency make a fraction of Gemini calls stall and
+--llm-down makes a model fail outright, to exercise hedging, the fallback
+models and the breaker; mix then prints which path served the outfits.
+
+startup measures a cold webhook process: import cost per module (bot's own
+imports, and the SDKs it loads lazily), then repeatedly spawns
+`bench.py serve` and times the first update from process start to the
+webhook's 200 and to the bot's first reply, with the server's startup stages.
+"""
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import logging
+import random
+import re
+import subprocess
+import sys
+from datetime import datetime
+from time import perf_counter
+
+import httpx
+from telegram import Update
+from telegram.request import BaseRequest
+
+import bot
+
+# --- Stand-ins ---
+class FakeTelegram(BaseRequest):
+    """Answers Bot API calls locally; every sent or edited message is kept in
+    .sent, and the inline keyboard last sent to each chat in .markups"""
+
+    def __init__(self):
+        self.message_ids = itertools.count(1000)
+        self.sent = []
+        self.markups = {}
+
+    @property
+    def read_timeout(self):
+        return 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif endpoint == "getWebhookInfo":
+            result = {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        elif endpoint in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            self.sent.append((chat_id, endpoint, params.get("text")))
+            markup = params.get("reply_markup")
+            self.markups[chat_id] = json.loads(markup) if isinstance(markup, str) else markup
+            result = {
+                "message_id": int(params.get("message_id") or next(self.message_ids)),
+                "date": int(datetime.now().timestamp()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text"),
+            }
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class _Result:
+    def __init__(self, data):
+        self.data = data
+
+
+class _Query:
+    def __init__(self, store, table):
+        self.store = store
+        self.table = table
+        self.op = "select"
+        self.payload = None
+        self.filters = []
+        self.ordering = []
+        self.max_rows = None
+
+    def select(self, *columns, **kwargs):
+        return self
+
+    def insert(self, payload, **kwargs):
+        self.op, self.payload = "insert", payload
+        return self
+
+    def upsert(self, payload, on_conflict="id", ignore_duplicates=False, **kwargs):
+        self.op, self.payload, self.conflict = "upsert", payload, on_conflict.split(",")
+        self.ignore_duplicates = ignore_duplicates
+        return self
+
+    def update(self, payload, **kwargs):
+        self.op, self.payload = "update", payload
+        return self
+
+    def delete(self, **kwargs):
+        self.op = "delete"
+        return self
+
+    def _where(self, predicate):
+        self.filters.append(predicate)
+        return self
+
+    def eq(self, column, value):
+        return self._where(lambda r: r.get(column) == value)
+
+    def neq(self, column, value):
+        return self._where(lambda r: r.get(column) != value)
+
+    def in_(self, column, values):
+        values = list(values)
+        return self._where(lambda r: r.get(column) in values)
+
+    def is_(self, column, value):
+        return self._where(lambda r: r.get(column) is None if value == "null" else r.get(column) is value)
+
+    def gt(self, column, value):
+        return self._where(lambda r: r.get(column) is not None and r.get(column) > value)
+
+    def gte(self, column, value):
+        return self._where(lambda r: r.get(column) is not None and r.get(column) >= value)
+
+    def lt(self, column, value):
+        return self._where(lambda r: r.get(column) is not None and r.get(column) < value)
+
+    def lte(self, column, value):
+        return self._where(lambda r: r.get(column) is not None and r.get(column) <= value)
+
+    def ilike(self, column, pattern):
+        needle = pattern.strip("%").lower()
+        return self._where(lambda r: needle in str(r.get(column) or "").lower())
+
+    def order(self, column, desc=False):
+        self.ordering.append((column, desc))
+        return self
+
+    def limit(self, count):
+        self.max_rows = count
+        return self
+
+    async def execute(self):
+        await self.store.round_trip()
+        rows = self.store.tables.setdefault(self.table, [])
+        if self.op in ("insert", "upsert"):
+            inserted = []
+            for row in self.payload if isinstance(self.payload, list) else [self.payload]:
+                existing = self.op == "upsert" and next(
+                    (r for r in rows if all(r.get(c) == row.get(c) for c in self.conflict)), None)
+                if existing and self.ignore_duplicates:
+                    continue
+                if existing:
+                    existing.update(copy.deepcopy(row))
+                    row = existing
+                else:
+                    row = {"id": next(self.store.ids), "created_at": self.store.now(), **copy.deepcopy(row)}
+                    rows.append(row)
+                inserted.append(copy.deepcopy(row))
+            return _Result(inserted)
+        matched = [r for r in rows if all(f(r) for f in self.filters)]
+        if self.op == "update":
+            for row in matched:
+                row.update(copy.deepcopy(self.payload))
+        elif self.op == "delete":
+            self.store.tables[self.table] = [r for r in rows if r not in matched]
+        for column, desc in reversed(self.ordering):
+            matched.sort(key=lambda r: (r.get(column) is None, r.get(column)), reverse=desc)
+        if self.max_rows is not None:
+            matched = matched[:self.max_rows]
+        return _Result(copy.deepcopy(matched))
+
+
+class _Rpc:
+    def __init__(self, store, function, params):
+        self.store = store
+        self.function = function
+        self.params = params
+
+    async def execute(self):
+        await self.store.round_trip()
+        return _Result(copy.deepcopy(self.function(self.store, **self.params)))
+
+
+def _packing_list(store, chat_id, name):
+    return next((r for r in store.tables.get("packing_lists", [])
+                 if r.get("chat_id") == chat_id and r.get("name") == name), None)
+
+
+def rpc_list_add_items(store, p_chat_id, p_name, p_items):
+    row = _packing_list(store, p_chat_id, p_name)
+    if row is None:
+        return None
+    row["items"] = (row.get("items") or []) + list(p_items)
+    return row["items"]
+
+
+def rpc_list_remove_items(store, p_chat_id, p_name, p_positions):
+    row = _packing_list(store, p_chat_id, p_name)
+    if row is None:
+        return None
+    items = row.get("items") or []
+    row["items"] = [e for i, e in enumerate(items, 1) if i not in p_positions]
+    return {"items": row["items"], "removed": [e for i, e in enumerate(items, 1) if i in p_positions]}
+
+
+def rpc_list_move_item(store, p_chat_id, p_name, p_from, p_to):
+    row = _packing_list(store, p_chat_id, p_name)
+    if row is None:
+        return None
+    items = list(row.get("items") or [])
+    if not 1 <= p_from <= len(items):
+        return {"items": items, "moved": None}
+    item = items.pop(p_from - 1)
+    items.insert(max(p_to, 1) - 1, item)
+    row["items"] = items
+    return {"items": items, "moved": item}
+
+
+def rpc_wear_outfit(store, p_chat_id, p_history_key, p_day):
+    history = next((r for r in store.tables.get("outfit_history", [])
+                    if r.get("chat_id") == p_chat_id and r.get("idempotency_key") == p_history_key
+                    and not r.get("worn_on")), None)
+    if history is None:
+        return 0
+    history["worn_on"] = p_day
+    ids = {r["item_id"] for r in store.tables.get("outfit_history_items", []) if r.get("history_key") == p_history_key}
+    items = [r for r in store.tables.get("items", []) if r.get("chat_id") == p_chat_id and r["id"] in ids]
+    for item in items:
+        item["times_worn"] = (item.get("times_worn") or 0) + 1
+        item["last_worn"] = p_day
+    return len(items)
+
+
+def rpc_set_item_status(store, p_chat_id, p_ids, p_status, p_reason=None):
+    items = [r for r in store.tables.get("items", []) if r.get("chat_id") == p_chat_id and r["id"] in p_ids]
+    for item in items:
+        item["status"] = p_status
+        if p_reason is not None:
+            item["details"] = {**(item.get("details") or {}), "status_reason": p_reason}
+    return len(items)
+
+
+class FakeSupabase:
+    """Just enough of PostgREST (query builder and the migrations' RPCs) for bot.py, with a fixed latency per call"""
+
+    functions = {
+        "list_add_items": rpc_list_add_items,
+        "list_remove_items": rpc_list_remove_items,
+        "list_move_item": rpc_list_move_item,
+        "wear_outfit": rpc_wear_outfit,
+        "set_item_status": rpc_set_item_status,
+    }
+
+    def __init__(self, latency=0.01):
+        self.latency = latency
+        self.tables = {}
+        self.ids = itertools.count(1)
+        self.clock = itertools.count(1)
+        self.calls = 0
+        self.down = False  # set to simulate an outage
+
+    def now(self):
+        return f"{datetime.now().date().isoformat()}T00:00:{next(self.clock):09d}"
+
+    async def round_trip(self):
+        self.calls += 1
+        if self.down:
+            raise httpx.ConnectError("bench: supabase is down")
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def table(self, name):
+        return _Query(self, name)
+
+    def rpc(self, name, params):
+        return _Rpc(self, self.functions[name], params)
+
+
+class _Chunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class _FakeModels:
+    def __init__(self, gemini):
+        self.gemini = gemini
+
+    async def generate_content(self, **request):
+        self.gemini.calls += 1
+        await self.gemini.stall(request)
+        await asyncio.sleep(self.gemini.latency)
+        return _Chunk(self.gemini.answer(request))
+
+    async def generate_content_stream(self, **request):
+        self.gemini.calls += 1
+        await self.gemini.stall(request)
+        text = self.gemini.answer(request)
+        lines = text.splitlines(keepends=True)
+
+        async def chunks():
+            for line in lines:
+                await asyncio.sleep(self.gemini.latency / len(lines))
+                yield _Chunk(line)
+        return chunks()
+
+    async def get(self, **kwargs):
+        return None
+
+
+class FakeGemini:
+    """Stands in for genai.Client: fixed latency, canned outfit built from the
+    prompt's item rows. A tail fraction of calls stalls tail_latency more
+    before answering, and models in down always fail."""
+
+    def __init__(self, latency=0.5, tail=0.0, tail_latency=5.0, down=()):
+        self.latency = latency
+        self.tail = tail
+        self.tail_latency = tail_latency
+        self.down = set(down)
+        self.calls = 0
+        self.aio = self
+        self.models = _FakeModels(self)
+
+    async def stall(self, request):
+        if request["model"] in self.down:
+            await asyncio.sleep(self.latency / 10)
+            raise RuntimeError(f"503 {request['model']} unavailable")
+        if random.random() < self.tail:
+            await asyncio.sleep(self.tail_latency)
+
+    def answer(self, request):
+        rows = [line for line in request["contents"].splitlines() if "|" in line and line.split("|")[0].isdigit()]
+        if getattr(request.get("config"), "response_mime_type", None) == "application/json":
+            # A trip plan: the same few items every day, plus a fresh top
+            days = int(re.search(r"VIAJE: (\d+)", request["contents"])[1])
+            ids = [int(r.split("|")[0]) for r in rows]
+            base = random.sample(ids, min(4, len(ids)))
+            plan = [{"title": f"Bench día {n + 1}", "items": base + [random.choice(ids)], "why": "bench"} for n in range(days)]
+            return json.dumps({"days": plan, "extras": ["cargador", "paraguas"], "alerts": ""})
+        picks = random.sample(rows, min(5, len(rows)))
+        return "🔥 Bench fit\n\n" + "\n".join(f"👕 [{r.split('|')[0]}] {r.split('|')[1]}" for r in picks) + "\n\n💡 bench"
+
+    async def aclose(self):
+        pass
+
+
+WEATHER = {
+    "current_condition": [{"temp_C": "21", "FeelsLikeC": "20", "humidity": "40", "lang_es": [{"value": "Despejado"}]}],
+    "weather": [
+        {"date": f"2026-01-0{n}", "maxtempC": str(25 + n), "mintempC": str(11 + n),
+         "hourly": [{"chanceofrain": "10", "lang_es": [{"value": "Despejado"}]}] * 8}
+        for n in (1, 2, 3)
+    ],
+}
+
+
+def fake_wttr(latency=0.05):
+    """httpx client whose transport answers every wttr.in request with WEATHER"""
+    async def handler(request):
+        bot.stats["bench_wttr_calls"] += 1
+        if latency:
+            await asyncio.sleep(latency)
+        return httpx.Response(200, json=WEATHER)
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def install(db_latency=0.01, llm_latency=0.5, weather_latency=0.05, llm_tail=0.0, llm_tail_latency=5.0, llm_down=()):
+    """Point bot.py at fresh stand-ins and reset its in-process state"""
+    bot.db = FakeSupabase(db_latency)
+    bot.gemini = FakeGemini(llm_latency, llm_tail, llm_tail_latency, llm_down)
+    bot.http = fake_wttr(weather_latency)
+    # The point is to load the bot, not to measure its quota protection
+    bot.LLM_CHAT_PER_MINUTE = bot.LLM_CHAT_BURST = 10 ** 9
+    bot._global_bucket = bot.TokenBucket(10 ** 9, 10 ** 9)
+    bot._chat_buckets.clear()
+    bot._inflight.clear()
+    bot._breakers.clear()
+    bot._llm_latencies.clear()
+    bot._histograms.clear()
+    bot.journal = bot.Journal(":memory:")
+    bot._remote_down_at = None
+    bot.wardrobes.clear()
+    bot.response_cache.clear()
+    bot._weather_cache.clear()
+    bot.stats.clear()
+    return bot.db, bot.gemini
+
+
+def seed_closet(store, chat_id, size):
+    """size clean items spread over every category; returns their ids"""
+    rows = store.tables.setdefault("items", [])
+    ids = []
+    for n in range(size):
+        category = bot.ALL_CATEGORIES[n % len(bot.ALL_CATEGORIES)]
+        ids.append(next(store.ids))
+        rows.append({
+            "id": ids[-1], "chat_id": chat_id, "category": category,
+            "name": f"{category} {n}", "status": "clean",
+            "details": {"color": random.choice(["negro", "gris", "azul"])},
+            "location": None, "times_worn": 0, "last_worn": None,
+        })
+    return ids
+
+
+_update_ids = itertools.count(1)
+
+def make_update(app, chat_id, text):
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(datetime.now().timestamp()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return Update.de_json({"update_id": next(_update_ids), "message": message}, app.bot)
+
+
+def make_callback(app, chat_id, data):
+    """An inline button tap on the bot's last message in the chat"""
+    user = {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"}
+    message = {
+        "message_id": next(_update_ids),
+        "date": int(datetime.now().timestamp()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+        "text": "…",
+    }
+    query = {"id": str(next(_update_ids)), "from": user, "chat_instance": str(chat_id),
+             "message": message, "data": data}
+    return Update.de_json({"update_id": next(_update_ids), "callback_query": query}, app.bot)
+
+
+async def dispatch(app, update):
+    """Feed an update through the Application's update processor, as the webhook/poller does"""
+    await app.update_processor.process_update(update, app.process_update(update))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] if values else 0.0
+
+
+def summarize(latencies):
+    return {f"p{pct}": round(percentile(latencies, pct) * 1000, 1) for pct in (50, 95, 99)} | {"n": len(latencies)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return "?"
+
+
+# --- Scenarios ---
+async def bench_chats(args):
+    """Outfit requests from N chats at once: per-chat serialization, cross-chat parallelism"""
+    print(f"{'closet':>6} {'chats':>6} {'requests':>9} {'wall s':>8} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    results = {}
+    for closet, chats in itertools.product(args.closet, args.chats):
+        store, _ = install(args.db_latency, args.llm_latency, args.weather_latency,
+                           args.llm_tail, args.llm_tail_latency, args.llm_down)
+        app = bot.build_application("1:bench", request=FakeTelegram())
+        await app.initialize()
+        bot.start_journal()
+        for chat_id in range(1, chats + 1):
+            seed_closet(store, chat_id, closet)
+        latencies = []
+
+        async def one_chat(chat_id):
+            # A newer request would supersede a pending one, so each chat waits for its answer
+            for n in range(args.requests):
+                start = perf_counter()
+                await dispatch(app, make_update(app, chat_id, f"outfit para hoy #{n}"))
+                latencies.append(perf_counter() - start)
+
+        start = perf_counter()
+        await asyncio.gather(*(one_chat(c) for c in range(1, chats + 1)))
+        wall = perf_counter() - start
+        total = chats * args.requests
+        print(f"{closet:>6} {chats:>6} {total:>9} {wall:>8.2f} {total / wall:>8.1f} "
+              f"{percentile(latencies, 50) * 1000:>8.0f} {percentile(latencies, 95) * 1000:>8.0f}")
+        results[f"closet{closet}-chats{chats}"] = {"outfit": summarize(latencies), "updates_per_s": round(total / wall, 2)}
+        await bot.stop_journal()
+        await app.shutdown()
+    return results
+
+
+LAZY_MODULES = ["google.genai", "supabase"]
+STARTUP_STAGES = ["startup_listen", "startup_initialize", "import_genai", "import_supabase", "startup_clients", "startup_ready"]
+
+
+def import_costs():
+    """ms per module from `python -X importtime`: bot and what it imports directly, then
+    each lazily imported SDK on top of bot"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import bot, {', '.join(LAZY_MODULES)}"],
+        capture_output=True, text=True,
+    ).stderr
+    costs, children = [], []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        # importtime prints children before their parent
+        if depth == 1:
+            children.append((depth, name.strip(), int(cumulative) / 1000))
+        elif depth == 0:
+            if name.strip() in ["bot"] + LAZY_MODULES:
+                costs.append((0, name.strip(), int(cumulative) / 1000))
+                costs += sorted(children, key=lambda c: -c[2])[:8]
+            children = []
+    return costs
+
+
+def startup_stages(metrics):
+    """Seconds per startup stage, from the server's /metrics"""
+    stages = {}
+    for line in metrics.splitlines():
+        match = re.match(r'outfit_bot_stage_seconds_sum\{stage="([a-z_]+)"\} ([0-9.]+)', line)
+        if match and match.group(1) in STARTUP_STAGES:
+            stages[match.group(1)] = float(match.group(2))
+    return stages
+
+
+async def time_startup(port, timeout=30):
+    """Spawn `bench.py serve` and time the first update: (ack s, first reply s, server stages)"""
+    url = f"http://127.0.0.1:{port}"
+    update = {"update_id": 1, "message": {
+        "message_id": 1, "date": int(datetime.now().timestamp()),
+        "chat": {"id": 1, "type": "private"}, "from": {"id": 1, "is_bot": False, "first_name": "bench"},
+        "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+    }}
+    start = perf_counter()
+    proc = subprocess.Popen([sys.executable, __file__, "serve", "--port", str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    ack = None
+    try:
+        async with httpx.AsyncClient(timeout=5) as client:
+            while perf_counter() - start < timeout:
+                try:
+                    if ack is None:
+                        if (await client.post(f"{url}/webhook", json=update)).status_code == 200:
+                            ack = perf_counter() - start
+                    else:
+                        metrics = (await client.get(f"{url}/metrics")).text
+                        if 'outfit_bot_telegram_seconds_count{method="sendMessage"}' in metrics:
+                            return ack, perf_counter() - start, startup_stages(metrics)
+                except httpx.TransportError:
+                    pass
+                await asyncio.sleep(0.005)
+        raise RuntimeError(f"no reply from bench.py serve within {timeout}s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+async def bench_startup(args):
+    """Cold start: import costs, then time to first ack/reply over --runs fresh processes"""
+    print(f"{'module':<32} {'import ms':>10}")
+    for depth, name, ms in import_costs():
+        lazy = " (lazy)" if name in LAZY_MODULES else ""
+        print(f"{'  ' * depth}{name + lazy:<{32 - 2 * depth}} {ms:>10.1f}")
+    acks, replies, stages = [], [], {}
+    for run in range(args.runs):
+        ack, reply, run_stages = await time_startup(args.port + run)
+        acks.append(ack)
+        replies.append(reply)
+        for name, seconds in run_stages.items():
+            stages.setdefault(name, []).append(seconds)
+    print(f"\n{'stage':<32} {'p50 ms':>10} {'max ms':>10}")
+    for name in STARTUP_STAGES:
+        if name in stages:
+            print(f"{name:<32} {percentile(stages[name], 50) * 1000:>10.0f} {max(stages[name]) * 1000:>10.0f}")
+    for name, values in (("first update acked", acks), ("first reply sent", replies)):
+        print(f"{name:<32} {percentile(values, 50) * 1000:>10.0f} {max(values) * 1000:>10.0f}")
+    return {"startup": {"ack": summarize(acks), "first_reply": summarize(replies)}}
+
+
+async def serve_startup(app):
+    """on_startup without real clients; the lazy SDK imports are still paid for, in the same order"""
+    with bot.stage("startup_clients"):
+        await asyncio.to_thread(bot.import_supabase)
+        bot.start_journal()
+    asyncio.ensure_future(asyncio.to_thread(bot.import_genai))
+
+
+async def serve(args):
+    """bot.serve_webhook on the stand-ins (what `startup` spawns)"""
+    install(args.db_latency, args.llm_latency, args.weather_latency,
+            args.llm_tail, args.llm_tail_latency, args.llm_down)
+    app = bot.build_application("1:bench", request=FakeTelegram(), updater=False)
+    app.post_init = serve_startup
+    await bot.serve_webhook(app, args.port, f"http://127.0.0.1:{args.port}/webhook")
+
+
+OCCASIONS = ["trabajo", "cena con amigos", "cita", "concierto", "día de lluvia", "domingo casual", "oficina", "gym"]
+UPDATES_PER_OP = {"outfit": 1, "message": 1, "closet": 2, "bulk": 2, "status": 1, "laundry": 1, "trip": 1}
+
+
+async def op_outfit(app, chat_id, rng, item_ids):
+    await dispatch(app, make_update(app, chat_id, f"/outfit {rng.choice(OCCASIONS)}"))
+
+
+async def op_message(app, chat_id, rng, item_ids):
+    await dispatch(app, make_update(app, chat_id, f"qué me pongo para {rng.choice(OCCASIONS)}"))
+
+
+async def op_closet(app, chat_id, rng, item_ids):
+    await dispatch(app, make_update(app, chat_id, "/closet"))
+    # Then ▶️, or a jump to page one when the closet fits on one page
+    markup = app.bot.request.inner.markups.get(chat_id) or {}
+    buttons = [b["callback_data"] for row in markup.get("inline_keyboard", []) for b in row]
+    data = next((d for d in buttons if ":n:" in d), "closet:all:n::0")
+    await dispatch(app, make_callback(app, chat_id, data))
+
+
+async def op_trip(app, chat_id, rng, item_ids):
+    await dispatch(app, make_update(app, chat_id, f"me voy a {rng.choice(['CDMX', 'Monterrey', 'Oaxaca'])} {rng.randint(2, 5)} días"))
+
+
+async def op_bulk(app, chat_id, rng, item_ids):
+    await dispatch(app, make_update(app, chat_id, "/bulk"))
+    lines = []
+    for n in range(rng.randint(5, 30)):
+        category = rng.choice(bot.ALL_CATEGORIES)
+        lines.append(f"{category}: bulk {category} {rng.randrange(10 ** 6)} | color: {rng.choice(['negro', 'gris'])}")
+    await dispatch(app, make_update(app, chat_id, "\n".join(lines)))
+
+
+async def op_status(app, chat_id, rng, item_ids):
+    command = rng.choice(["/dirty", "/dirty", "/clean", "/clean", "/lost"])
+    ids = rng.sample(item_ids, min(len(item_ids), 1 if command == "/lost" else rng.randint(1, 4)))
+    await dispatch(app, make_update(app, chat_id, f"{command} {' '.join(map(str, ids))}"))
+
+
+async def op_laundry(app, chat_id, rng, item_ids):
+    text = rng.choice(["/clean all", f"/clean {rng.choice(bot.ALL_CATEGORIES)}", "/dirty all", "laundry done"])
+    await dispatch(app, make_update(app, chat_id, text))
+
+
+OPERATIONS = {
+    "outfit": op_outfit, "message": op_message, "closet": op_closet, "bulk": op_bulk, "status": op_status,
+    "laundry": op_laundry, "trip": op_trip,
+}
+
+
+def parse_mix(text):
+    weights = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {name!r}; pick from {', '.join(OPERATIONS)}")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+async def bench_mix(args):
+    """A weighted mix of real handler traffic from --concurrency chats, one update at a time per chat"""
+    names = list(args.mix)
+    results = {}
+    header = f"{'closet':>6} {'conc':>5} {'op':>8} {'n':>6} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    print(header)
+    for closet, concurrency in itertools.product(args.closet, args.concurrency):
+        store, gemini = install(args.db_latency, args.llm_latency, args.weather_latency,
+                                args.llm_tail, args.llm_tail_latency, args.llm_down)
+        app = bot.build_application("1:bench", request=FakeTelegram())
+        await app.initialize()
+        bot.start_journal()
+        rng = random.Random(args.seed)
+        item_ids = {chat_id: seed_closet(store, chat_id, closet) for chat_id in range(1, concurrency + 1)}
+        latencies = {name: [] for name in names}
+        budget = itertools.count()
+        updates = 0
+
+        async def worker(chat_id):
+            nonlocal updates
+            chat_rng = random.Random(rng.random())
+            while next(budget) < args.updates:
+                name = chat_rng.choices(names, weights=[args.mix[n] for n in names])[0]
+                start = perf_counter()
+                await OPERATIONS[name](app, chat_id, chat_rng, item_ids[chat_id])
+                latencies[name].append(perf_counter() - start)
+                updates += UPDATES_PER_OP[name]
+
+        start = perf_counter()
+        await asyncio.gather(*(worker(c) for c in range(1, concurrency + 1)))
+        wall = perf_counter() - start
+        run = {name: summarize(values) for name, values in latencies.items() if values}
+        run["updates_per_s"] = round(updates / wall, 2)
+        results[f"closet{closet}-conc{concurrency}"] = run
+        for name, summary in run.items():
+            if name != "updates_per_s":
+                print(f"{closet:>6} {concurrency:>5} {name:>8} {summary['n']:>6} "
+                      f"{summary['p50']:>8.1f} {summary['p95']:>8.1f} {summary['p99']:>8.1f}")
+        print(f"{closet:>6} {concurrency:>5} {'total':>8} {updates:>6} updates in {wall:.2f}s = "
+              f"{run['updates_per_s']} updates/s, {store.calls} db calls, {gemini.calls} llm calls")
+        paths = llm_paths()
+        if paths:
+            print(f"{'':>21} served by " + ", ".join(f"{path}={n}" for path, n in paths.items()))
+        await bot.stop_journal()
+        await app.shutdown()
+    return results
+
+
+def llm_paths():
+    """Outfit requests per serving path (cache, model, model+hedge, local...), from bot's histograms"""
+    return {
+        dict(labels)["path"]: sum(histogram.counts)
+        for (metric, labels), histogram in sorted(bot._histograms.items())
+        if metric == "llm_request_seconds"
+    }
+
+
+def compare(baseline, results, tolerance):
+    """Print p95 and throughput deltas against a saved run; returns the regressions"""
+    regressions = []
+    print(f"\nvs {baseline.get('commit', '?')} (tolerance {tolerance:.0%})")
+    for run, ops in results.items():
+        before = baseline["results"].get(run)
+        if not before:
+            continue
+        for name, summary in ops.items():
+            if name == "updates_per_s":
+                old, new = before.get(name), summary
+                worse = old and new < old * (1 - tolerance)
+                label = "updates/s"
+            else:
+                old, new = before.get(name, {}).get("p95"), summary["p95"]
+                worse = old and new > old * (1 + tolerance)
+                label = f"{name} p95"
+            if not old:
+                continue
+            flag = "  REGRESSION" if worse else ""
+            print(f"  {run:>18} {label:>14}: {old:>9} → {new:<9} ({(new - old) / old:+.0%}){flag}")
+            if worse:
+                regressions.append((run, label))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-latency", type=float, default=0.01, help="seconds per Supabase call")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="seconds per Gemini call (spread over streamed chunks)")
+    parser.add_argument("--llm-tail", type=float, default=0.0, help="fraction of Gemini calls that stall")
+    parser.add_argument("--llm-tail-latency", type=float, default=5.0, help="extra seconds a stalled call takes")
+    parser.add_argument("--llm-down", action="append", default=[], metavar="MODEL", help="model whose calls all fail")
+    parser.add_argument("--weather-latency", type=float, default=0.05, help="seconds per wttr.in call")
+    parser.add_argument("--save", metavar="FILE", help="write results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="compare against results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed p95/throughput regression (0.2 = 20%%)")
+    sizes = argparse.ArgumentParser(add_help=False)
+    sizes.add_argument("--closet", type=int, nargs="+", default=[60], help="items per chat")
+    sub = parser.add_subparsers(dest="scenario", required=True)
+    chats = sub.add_parser("chats", parents=[sizes], help="throughput vs number of active chats")
+    chats.add_argument("--chats", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    chats.add_argument("--requests", type=int, default=5, help="outfit requests per chat")
+    mix = sub.add_parser("mix", parents=[sizes], help="latency per handler under a mixed workload")
+    mix.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="chats sending at once")
+    mix.add_argument("--updates", type=int, default=300, help="operations per run")
+    mix.add_argument("--mix", type=parse_mix, default=parse_mix("outfit=2,message=2,closet=2,bulk=1,status=3,laundry=1"))
+    mix.add_argument("--seed", type=int, default=1)
+    startup = sub.add_parser("startup", help="cold start: import costs and time to first update")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.add_argument("--port", type=int, default=18080, help="first port; each run uses the next one")
+    serve_parser = sub.add_parser("serve", help="run the webhook server on the stand-ins")
+    serve_parser.add_argument("--port", type=int, default=18080)
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    if args.scenario == "serve":
+        asyncio.run(serve(args))
+        return
+    results = asyncio.run({"chats": bench_chats, "mix": bench_mix, "startup": bench_startup}[args.scenario](args))
+
+    saved = {"commit": git_commit(), "scenario": args.scenario, "results": results}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(saved, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(baseline, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,38 @@
-import json
+import asyncio
 import os
+import json
 import logging
-import urllib.request
+import re
+import unicodedata
+import hashlib
+import sqlite3
+import uuid
+import weakref
+import bisect
+import signal
+import contextvars
 import urllib.parse
-from datetime import datetime, time
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from pathlib import Path
-from telegram import Update
+from time import monotonic, perf_counter
+from collections import Counter, OrderedDict, deque
+STARTED_AT = perf_counter()
+import httpx
+import tornado.web
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.error import BadRequest
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler,
+    Application, BaseUpdateProcessor, CallbackQueryHandler, CommandHandler, MessageHandler,
     ContextTypes, filters
 )
-from google import genai
-from supabase import create_client, Client
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
 
 # --- Config ---
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
@@ -21,48 +42,1211 @@ SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 OWNER_CHAT_ID = int(os.getenv("OWNER_CHAT_ID", "0"))
 DAILY_HOUR = int(os.getenv("DAILY_HOUR", "7"))
 DAILY_MINUTE = int(os.getenv("DAILY_MINUTE", "0"))
-TIMEZONE_OFFSET = int(os.getenv("TIMEZONE_OFFSET", "-6"))
+TIMEZONE_OFFSET = int(os.getenv("TIMEZONE_OFFSET", "-6"))  # for profiles without a timezone
+DAILY_PRECOMPUTE_WINDOW = int(os.getenv("DAILY_PRECOMPUTE_WINDOW", "3600"))
+DAILY_PRECOMPUTE_MIN_LEAD = int(os.getenv("DAILY_PRECOMPUTE_MIN_LEAD", "900"))
+DAILY_PLAN_INTERVAL = int(os.getenv("DAILY_PLAN_INTERVAL", "600"))
+DAILY_WORKERS = int(os.getenv("DAILY_WORKERS", "4"))
+DAILY_MAX_ATTEMPTS = int(os.getenv("DAILY_MAX_ATTEMPTS", "4"))
+DAILY_RETRY_BASE = float(os.getenv("DAILY_RETRY_BASE", "30"))
+WEATHER_TTL = int(os.getenv("WEATHER_TTL", "1800"))
+WEATHER_MAX_STALE = int(os.getenv("WEATHER_MAX_STALE", "21600"))
+WEATHER_REFRESH_INTERVAL = int(os.getenv("WEATHER_REFRESH_INTERVAL", "900"))
+WARDROBE_RECONCILE_INTERVAL = int(os.getenv("WARDROBE_RECONCILE_INTERVAL", "600"))
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "100"))
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") != "0"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+TELEGRAM_MAX_MESSAGE = 4000
+CLOSET_PAGE_SIZE = int(os.getenv("CLOSET_PAGE_SIZE", "30"))  # items per /closet, /available page
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "128"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "10800"))
+# Update dispatch: every update takes a fast-lane worker once its chat is free;
+# Gemini calls move to the LLM lane, whose queue is bounded (see Lane)
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "1024"))  # updates held at once, any state
+FAST_WORKERS = int(os.getenv("FAST_WORKERS", "32"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_QUEUE_MAX = int(os.getenv("LLM_QUEUE_MAX", "32"))  # more waiting than this get a "busy" reply
+LLM_CHAT_PER_MINUTE = float(os.getenv("LLM_CHAT_PER_MINUTE", "4"))
+LLM_CHAT_BURST = int(os.getenv("LLM_CHAT_BURST", "3"))
+LLM_GLOBAL_PER_MINUTE = float(os.getenv("LLM_GLOBAL_PER_MINUTE", "60"))
+LLM_GLOBAL_BURST = int(os.getenv("LLM_GLOBAL_BURST", "10"))
+LLM_GLOBAL_MAX_WAIT = float(os.getenv("LLM_GLOBAL_MAX_WAIT", "20"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "20"))  # one attempt at one model
+LLM_BUDGET = float(os.getenv("LLM_BUDGET", "30"))  # every attempt of one request, then the local engine
+LLM_FALLBACK_MODELS = [m.strip() for m in os.getenv("LLM_FALLBACK_MODELS", "gemini-2.5-flash-lite").split(",") if m.strip()]
+LLM_FALLBACK_MAX_TOKENS = int(os.getenv("LLM_FALLBACK_MAX_TOKENS", "1500"))
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "8"))  # until a model has LLM_HEDGE_SAMPLES latencies
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "1"))
+LLM_HEDGE_SAMPLES = int(os.getenv("LLM_HEDGE_SAMPLES", "20"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "60"))
+LOCAL_ONLY = os.getenv("LOCAL_ONLY", "0") == "1"  # never call Gemini, always the local engine
+OUTFIT_CANDIDATES = int(os.getenv("OUTFIT_CANDIDATES", "4"))
+ROTATION_LEAST_WORN = int(os.getenv("ROTATION_LEAST_WORN", "5"))
+TRIP_MAX_DAYS = int(os.getenv("TRIP_MAX_DAYS", "7"))
+TRIP_TOKENS_PER_DAY = int(os.getenv("TRIP_TOKENS_PER_DAY", "500"))  # plus 500 for extras and notes
+# The write-behind journal must live on a disk that survives restarts (on
+# Render, a persistent disk mount). Render's own disk doesn't, so there, unless
+# JOURNAL_PATH is set, or anywhere with JOURNAL_PATH="", writes go through:
+# each one reaches Supabase before the handler replies (see journal_commit).
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "" if os.getenv("RENDER") else "journal.sqlite3")
+JOURNAL_WRITE_THROUGH = not JOURNAL_PATH
+JOURNAL_COMMIT_TIMEOUT = float(os.getenv("JOURNAL_COMMIT_TIMEOUT", "10"))
+JOURNAL_FLUSH_INTERVAL = float(os.getenv("JOURNAL_FLUSH_INTERVAL", "2"))
+JOURNAL_BATCH = int(os.getenv("JOURNAL_BATCH", "200"))
+JOURNAL_MAX_ATTEMPTS = int(os.getenv("JOURNAL_MAX_ATTEMPTS", "20"))
+REMOTE_RETRY_AFTER = float(os.getenv("REMOTE_RETRY_AFTER", "30"))
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("outfit-bot")
 
+# Process-wide counters (weather_hit, weather_miss, weather_stale, ...)
+stats = Counter()
+
+# Fire-and-forget tasks; the event loop only keeps weak references to them
+_background_tasks = set()
+
+def spawn(coro) -> asyncio.Task:
+    """Run coro in the background, holding on to it until it's done"""
+    task = asyncio.ensure_future(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
 ALL_CATEGORIES = [
     "underwear", "socks", "calzado", "pantalones", "tops", "capas",
     "gorras", "smartwatch_bands", "relojes", "anillos", "cadenas",
     "pulseras", "plugs", "lentes", "extras"
 ]
 
-# --- Supabase DB ---
-db: Client = None
+# --- Metrics ---
+# Latency histograms per stage (queue wait, Supabase/Gemini/wttr calls,
+# context fetches, prompt build, LLM ttft/total, Telegram sends) next to the
+# stats counters, served in Prometheus text format on /metrics. With the
+# opentelemetry package installed, stage() also opens a span, so running
+# under opentelemetry-instrument exports traces too.
+HISTOGRAM_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+tracer = trace.get_tracer("outfit-bot") if trace else None
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(HISTOGRAM_BUCKETS, value)] += 1
+        self.sum += value
+
+_histograms = {}  # (metric, ((label, value), ...)) -> Histogram
+
+def observe(metric, seconds, **labels):
+    key = (metric, tuple(sorted(labels.items())))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram()
+    histogram.observe(seconds)
+
+@contextmanager
+def stage(name, **attributes):
+    """Time a block into stage_seconds{stage=name} (and a span, if tracing)"""
+    span = tracer.start_as_current_span(name, attributes=attributes) if tracer else nullcontext()
+    start = perf_counter()
+    with span:
+        try:
+            yield
+        finally:
+            observe("stage_seconds", perf_counter() - start, stage=name)
+
+def _labels(pairs):
+    return ",".join(f'{k}="{str(v).replace(chr(34), "")}"' for k, v in pairs)
+
+def render_metrics() -> str:
+    lines = ["# TYPE outfit_bot_events_total counter"]
+    lines += [f'outfit_bot_events_total{{event="{k}"}} {v}' for k, v in sorted(stats.items())]
+    lines += [
+        "# TYPE outfit_bot_chats_loaded gauge", f"outfit_bot_chats_loaded {len(wardrobes)}",
+        "# TYPE outfit_bot_response_cache_entries gauge", f"outfit_bot_response_cache_entries {len(response_cache.entries)}",
+        "# TYPE outfit_bot_llm_in_flight gauge", f"outfit_bot_llm_in_flight {len(_inflight)}",
+        "# TYPE outfit_bot_journal_pending gauge", f"outfit_bot_journal_pending {journal.size() if journal else 0}",
+        "# TYPE outfit_bot_remote_down gauge", f"outfit_bot_remote_down {int(remote_down())}",
+        "# TYPE outfit_bot_lane_active gauge",
+        *(f'outfit_bot_lane_active{{lane="{lane.name}"}} {lane.active}' for lane in (fast_lane, llm_lane)),
+        "# TYPE outfit_bot_lane_waiting gauge",
+        *(f'outfit_bot_lane_waiting{{lane="{lane.name}"}} {lane.waiting}' for lane in (fast_lane, llm_lane)),
+    ]
+    for metric in sorted({m for m, _ in _histograms}):
+        lines.append(f"# TYPE outfit_bot_{metric} histogram")
+        for (name, labels), histogram in sorted(_histograms.items()):
+            if name != metric:
+                continue
+            cumulative = 0
+            for bound, count in zip(HISTOGRAM_BUCKETS + ("+Inf",), histogram.counts):
+                cumulative += count
+                lines.append(f"outfit_bot_{metric}_bucket{{{_labels(labels + (('le', bound),))}}} {cumulative}")
+            lines.append(f"outfit_bot_{metric}_sum{{{_labels(labels)}}} {histogram.sum:.6f}")
+            lines.append(f"outfit_bot_{metric}_count{{{_labels(labels)}}} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+class TimedRequest(BaseRequest):
+    """Bot API transport wrapper that times every call by method"""
+
+    def __init__(self, inner: BaseRequest):
+        self.inner = inner
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        start = perf_counter()
+        try:
+            return await self.inner.do_request(
+                url, method, request_data=request_data, read_timeout=read_timeout,
+                write_timeout=write_timeout, connect_timeout=connect_timeout, pool_timeout=pool_timeout,
+            )
+        finally:
+            observe("telegram_seconds", perf_counter() - start, method=endpoint)
+
+
+# --- HTTP Clients ---
+# One pooled httpx client per upstream (supabase, gemini, wttr), created on
+# Application start and closed on stop. stats counts requests and new TCP
+# connections per pool, so connection_reuse() shows how much keep-alive helps.
+# google.genai and supabase are most of the import time, so they're imported
+# on first use (init_clients, in a thread so the webhook keeps answering)
+# rather than before the webhook port is bound.
+genai = None
+gemini = None  # genai.Client
+http: httpx.AsyncClient = None
+_http_clients = []
+_gemini_init = None
+
+def import_genai():
+    global genai
+    if genai is None:
+        with stage("import_genai"):
+            from google import genai as module
+        genai = module
+    return genai
+
+def pooled_http_client(pool, **kwargs):
+    async def trace(event, info):
+        if event == "connection.connect_tcp.complete":
+            stats[f"http_{pool}_connections"] += 1
+
+    async def on_request(request):
+        stats[f"http_{pool}_requests"] += 1
+        request.extensions["trace"] = trace
+        request.extensions["started"] = perf_counter()
+
+    async def on_response(response):
+        # Time to response headers, by table (supabase) or model call (gemini)
+        request = response.request
+        target = request.url.path.rstrip("/").rsplit("/", 1)[-1] if pool != "wttr" else "forecast"
+        observe("http_seconds", perf_counter() - request.extensions["started"], pool=pool, target=target)
+        if response.status_code >= 400:
+            stats[f"http_{pool}_errors"] += 1
+
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        event_hooks={"request": [on_request], "response": [on_response]},
+        **kwargs,
+    )
+    _http_clients.append(client)
+    return client
+
+def connection_reuse():
+    """Share of requests per pool that went out on an already-open connection"""
+    reuse = {}
+    for key, requests in stats.items():
+        if key.startswith("http_") and key.endswith("_requests") and requests:
+            pool = key[len("http_"):-len("_requests")]
+            reuse[pool] = 1 - stats[f"http_{pool}_connections"] / requests
+    return reuse
+
+async def init_gemini():
+    global gemini
+    try:
+        await asyncio.to_thread(import_genai)
+        gemini = genai.Client(
+            api_key=GEMINI_API_KEY,
+            http_options=genai.types.HttpOptions(httpx_async_client=pooled_http_client("gemini", timeout=120)),
+        )
+    except Exception as e:
+        logger.error(f"Gemini client setup failed: {e!r}")
+
+async def gemini_ready():
+    """Wait for the Gemini client init_clients is still setting up, if any"""
+    if gemini is None and _gemini_init is not None:
+        await asyncio.wait([_gemini_init])
+
+async def init_clients():
+    """Supabase first; Gemini finishes in the background, since only outfit
+    requests need it and its SDK is the slowest import"""
+    global http, _gemini_init
+    http = pooled_http_client("wttr", timeout=15)
+    await init_db()
+    # Before any update: the owner's first /start would otherwise create a
+    # fresh profile the legacy one then collides with
+    await adopt_legacy_rows()
+    _gemini_init = asyncio.ensure_future(init_gemini())
+
+async def warm_up_clients():
+    """Open the Supabase and Gemini connections before the first update needs
+    them; runs in the background, alongside the first updates"""
+    try:
+        if OWNER_CHAT_ID:
+            await load_wardrobe(OWNER_CHAT_ID)
+    except Exception as e:
+        logger.warning(f"Supabase warm-up error: {e!r}")
+    try:
+        await gemini_ready()
+        await gemini.aio.models.get(model=GEMINI_MODEL)
+    except Exception as e:
+        logger.warning(f"Gemini warm-up error: {e}")
+
+async def close_clients():
+    await stop_journal()
+    await gemini_ready()
+    if gemini:
+        await gemini.aio.aclose()
+    while _http_clients:
+        await _http_clients.pop().aclose()
+    logger.info("Connection reuse: " + ", ".join(f"{k}={v:.0%}" for k, v in connection_reuse().items()))
+
+# --- Item Search ---
+def fold_text(text: str) -> str:
+    """Lowercase and strip accents so 'Calcetín' and 'calcetin' compare equal"""
+    decomposed = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def search_tokens(text: str) -> list:
+    tokens = []
+    for word in re.findall(r"[a-z0-9]+", fold_text(text)):
+        # Cheap Spanish plural folding: calcetines -> calcetin, negros -> negro
+        if len(word) > 4 and word.endswith("es") and word[-3] not in "aeiou":
+            word = word[:-2]
+        elif len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+def trigrams(token: str) -> set:
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class ItemIndex:
+    """Token + trigram index over item names and details.
+
+    search() returns items ranked by how well every query token is covered:
+    exact token 1.0, prefix 0.9, otherwise trigram similarity. Tokens from
+    details (brand, color, model...) count a bit less than name tokens. Only
+    items sharing enough trigrams with a query token to reach MIN_SIMILARITY
+    (or to start with it) get scored.
+    """
+
+    MIN_SIMILARITY = 0.45
+    DETAIL_WEIGHT = 0.85
+
+    def __init__(self):
+        self.docs = {}
+        self.postings = {}
+
+    def add(self, item):
+        self.remove(item["id"])
+        details = item.get("details") or {}
+        name_tokens = {t: trigrams(t) for t in search_tokens(item.get("name") or "")}
+        detail_text = " ".join(str(v) for k, v in details.items() if k != "status_reason" and v)
+        detail_tokens = {
+            t: trigrams(t) for t in search_tokens(f"{detail_text} {item.get('category') or ''}") if t not in name_tokens
+        }
+        grams = set().union(*name_tokens.values(), *detail_tokens.values())
+        self.docs[item["id"]] = (name_tokens, detail_tokens, grams)
+        for g in grams:
+            self.postings.setdefault(g, set()).add(item["id"])
+
+    def remove(self, item_id):
+        doc = self.docs.pop(item_id, None)
+        if doc:
+            for g in doc[2]:
+                ids = self.postings.get(g)
+                if ids:
+                    ids.discard(item_id)
+
+    def _token_credit(self, query_token, query_grams, tokens):
+        if query_token in tokens:
+            return 1.0
+        best = 0.0
+        for t, grams in tokens.items():
+            if len(query_token) >= 2 and t.startswith(query_token):
+                best = max(best, 0.9)
+                continue
+            sim = 2 * len(query_grams & grams) / (len(query_grams) + len(grams))
+            if sim >= self.MIN_SIMILARITY:
+                best = max(best, sim * 0.8)
+        return best
+
+    def search(self, query, limit=5):
+        """Ranked [(score, item_id, complete)]; complete means every query token matched"""
+        query_tokens = search_tokens(query)
+        if not query_tokens:
+            return []
+        token_grams = [trigrams(t) for t in query_tokens]
+        candidates = set()
+        for grams in token_grams:
+            hits = Counter()
+            for g in grams:
+                hits.update(self.postings.get(g, ()))
+            # Dice >= MIN_SIMILARITY against the shortest token (2 trigrams)
+            # needs this many shared trigrams; a prefix match has more
+            needed = self.MIN_SIMILARITY * (len(grams) + 2) / 2
+            candidates.update(item_id for item_id, n in hits.items() if n >= needed)
+        ranked = []
+        for item_id in candidates:
+            name_tokens, detail_tokens, _ = self.docs[item_id]
+            credits = [
+                max(self._token_credit(t, g, name_tokens),
+                    self._token_credit(t, g, detail_tokens) * self.DETAIL_WEIGHT)
+                for t, g in zip(query_tokens, token_grams)
+            ]
+            score = sum(credits) / len(credits)
+            if score > 0:
+                ranked.append((score, item_id, all(credits)))
+        ranked.sort(key=lambda r: (-r[0], r[1]))
+        return ranked[:limit]
+
+# --- Wardrobe Store ---
+def sort_key(item):
+    return (item.get("category") or "", item["id"])
+
+class Wardrobe:
+    """In-memory mirror of the items table.
+
+    The bot is the only regular writer, so db_add_item/db_update_item write
+    through to it and reads never leave the process. Stored dicts are replaced,
+    never mutated, so callers can hold on to what they read.
+    """
+
+    def __init__(self):
+        self.items = {}
+        self.index = ItemIndex()
+        self.order = {}  # status (None = every item) -> sorted [(category, id)], for page()
+        self.loaded = False
+        self.version = 0
+        self._rotation = (None, None)
+
+    def load(self, rows):
+        self.items = {r["id"]: r for r in rows}
+        self.index = ItemIndex()
+        self.order = {}
+        for item in rows:
+            self.index.add(item)
+            for view in (None, item.get("status")):
+                self.order.setdefault(view, []).append(sort_key(item))
+        for keys in self.order.values():
+            keys.sort()
+        self.loaded = True
+        self.version += 1
+
+    def put(self, item):
+        old = self.items.get(item["id"])
+        if old is not None:
+            for view in (None, old.get("status")):
+                keys = self.order.get(view, [])
+                i = bisect.bisect_left(keys, sort_key(old))
+                if i < len(keys) and keys[i] == sort_key(old):
+                    del keys[i]
+        for view in (None, item.get("status")):
+            bisect.insort(self.order.setdefault(view, []), sort_key(item))
+        self.items[item["id"]] = item
+        self.index.add(item)
+        self.version += 1
+
+    def patch(self, item_id, changes):
+        if item_id in self.items:
+            self.put({**self.items[item_id], **changes})
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    def page(self, status=None, after=None, before=None, limit=20):
+        """Keyset page in (category, id) order: the first limit items after the
+        key `after`, or the last limit before `before`. Returns (items, index
+        of the first one, total in the view); cost doesn't grow with the closet."""
+        keys = self.order.get(status, [])
+        if before is not None:
+            end = bisect.bisect_left(keys, before)
+            start = max(0, end - limit)
+        else:
+            start = bisect.bisect_right(keys, after) if after is not None else 0
+            end = start + limit
+        return [self.items[item_id] for _, item_id in keys[start:end]], start, len(keys)
+
+    def categories(self, status=None):
+        """Categories with at least one item in the view, in page order"""
+        keys = self.order.get(status, [])
+        found = []
+        for category in sorted(ALL_CATEGORIES):
+            i = bisect.bisect_left(keys, (category, 0))
+            if i < len(keys) and keys[i][0] == category:
+                found.append(category)
+        return found
+
+    def select(self, status=None, category=None):
+        statuses = set(status) if isinstance(status, (list, tuple)) else {status} if status else None
+        rows = [
+            i for i in self.items.values()
+            if (statuses is None or i.get("status") in statuses)
+            and (category is None or i.get("category") == category)
+        ]
+        rows.sort(key=sort_key)
+        return rows
+
+    def rotation(self):
+        """Wear stats, recomputed only after the wardrobe changes.
+
+        least_worn: clean items, fewest wears and longest rested first.
+        by_category: {category: {"items", "worn", "never"}} over clean and
+        dirty items (worn = total times_worn, never = items with no wear yet).
+        """
+        version, rotation = self._rotation
+        if version == self.version:
+            return rotation
+        in_use = [i for i in self.items.values() if i.get("status") in ("clean", "dirty")]
+        by_category = {}
+        for item in in_use:
+            counts = by_category.setdefault(item.get("category") or "", {"items": 0, "worn": 0, "never": 0})
+            counts["items"] += 1
+            counts["worn"] += item.get("times_worn") or 0
+            counts["never"] += not item.get("times_worn")
+        clean = [i for i in in_use if i.get("status") == "clean"]
+        clean.sort(key=lambda i: (i.get("times_worn") or 0, i.get("last_worn") or "", i["id"]))
+        rotation = {"least_worn": clean[:ROTATION_LEAST_WORN], "by_category": by_category}
+        self._rotation = (self.version, rotation)
+        return rotation
+
+    def search(self, query, limit=5):
+        """Ranked candidates for a name/details query, best first"""
+        return [self.items[item_id] for _, item_id, _ in self.index.search(query, limit)]
+
+    def find(self, ref):
+        """Resolve one reference: an item id, or the best complete name/details match"""
+        ref = ref.strip().lstrip("#")
+        if ref.isdigit() and int(ref) in self.items:
+            return self.items[int(ref)]
+        # Not an id: numbers also appear in names ("Dr Martens 1460")
+        for _, item_id, complete in self.index.search(ref, limit=1):
+            if complete:
+                return self.items[item_id]
+        return None
+
+    def find_leading(self, words):
+        """Resolve the longest leading run of words that names an item.
+
+        Returns (item, remaining_words), e.g. ['chamarra', 'negra', 'manchada']
+        -> (Chamarra negra, ['manchada']). An id only ever consumes one word.
+        """
+        if not words:
+            return None, words
+        if words[0].lstrip("#").isdigit():
+            return self.find(words[0]), words[1:]
+        for end in range(len(words), 0, -1):
+            item = self.find(" ".join(words[:end]))
+            if item:
+                return item, words[end:]
+        return None, words
+
+    def find_many(self, text):
+        """Resolve '3 5 calcetines negros, hoka' into [(ref, item or None)].
+
+        Numbers are ids; runs of words between numbers or commas are one query each.
+        """
+        refs = []
+        for chunk in text.split(","):
+            phrase = []
+            for word in chunk.split():
+                if word.lstrip("#").isdigit():
+                    if phrase:
+                        refs.append(" ".join(phrase))
+                        phrase = []
+                    refs.append(word)
+                else:
+                    phrase.append(word)
+            if phrase:
+                refs.append(" ".join(phrase))
+        return [(ref, self.find(ref)) for ref in refs]
+
+# One store per chat, loaded the first time that chat needs it
+wardrobes = {}
+
+# --- Response Cache ---
+class ResponseCache:
+    """LRU + TTL cache of outfit suggestions.
+
+    Keys fold in everything the answer depends on (see response_cache_key),
+    so a stale hit is only possible for changes the key can't see; item
+    writes clear the chat's entries outright to cover those.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or monotonic() - entry[0] > self.ttl:
+            self.entries.pop(key, None)
+            stats["response_cache_miss"] += 1
+            return None
+        self.entries.move_to_end(key)
+        stats["response_cache_hit"] += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self, chat_id=None):
+        if chat_id is None:
+            self.entries.clear()
+            return
+        for key in [k for k in self.entries if k[0] == chat_id]:
+            del self.entries[key]
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+
+def response_cache_key(chat_id, request, ctx):
+    """Chat + normalized request + city + date + weather bucket + clean-items fingerprint"""
+    clean = hashlib.sha1(
+        "|".join(f"{i['id']}:{i['name']}" for i in sorted(ctx["available"], key=lambda i: i["id"])).encode()
+    ).hexdigest()[:16]
+    return (
+        chat_id,
+        " ".join(search_tokens(request)),
+        fold_text(ctx["city"]),
+        ctx["now"].date().isoformat(),
+        weather_bucket(ctx["city"]),
+        clean,
+    )
+
+RETRY_PATTERN = re.compile(r"^(dame |quiero )?(otra|otro)( opcion| outfit| idea| diferente)*( porfa(vor)?)?$")
+
+def is_retry_request(text):
+    """'otra opción', 'dame otro', ... — asks for a different answer to the last request"""
+    return bool(RETRY_PATTERN.match(" ".join(re.findall(r"[a-z0-9]+", fold_text(text)))))
+
+WEAR_PATTERN = re.compile(r"^(va |listo |ok )?(me lo (pongo|llevo)|ese me lo (pongo|llevo)|lo (uso|usare))( hoy)?$")
+
+def is_wear_request(text):
+    """'me lo pongo', 'va, me lo llevo', ... — accepts the last suggestion"""
+    return bool(WEAR_PATTERN.match(" ".join(re.findall(r"[a-z0-9]+", fold_text(text)))))
+
+# --- Per-chat Concurrency ---
+# Updates run concurrently across chats but one at a time within a chat, so a
+# user's quick double message can't interleave its reads and writes. Handler
+# work runs on FAST_WORKERS fast-lane slots; an outfit request gives its slot
+# (and its chat's lock) back while it waits on Gemini, which has its own lane
+# of LLM_CONCURRENCY slots, so /clean and /list never queue behind the LLM.
+class Busy(Exception):
+    """A lane's queue is full; the caller should come back later"""
+
+class Lane:
+    """workers slots; with queue_max, a caller that would wait behind that
+    many others gets Busy instead of joining the queue"""
+
+    def __init__(self, name, workers, queue_max=None):
+        self.name = name
+        self.semaphore = asyncio.Semaphore(workers)
+        self.queue_max = queue_max
+        self.waiting = 0
+        self.active = 0
+
+    async def acquire(self):
+        if self.queue_max is not None and self.semaphore.locked() and self.waiting >= self.queue_max:
+            stats[f"lane_{self.name}_busy"] += 1
+            raise Busy(f"{self.name} lane full")
+        self.waiting += 1
+        start = perf_counter()
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        observe("stage_seconds", perf_counter() - start, stage=f"lane_{self.name}_wait")
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+fast_lane = Lane("fast", FAST_WORKERS)
+llm_lane = Lane("llm", LLM_CONCURRENCY, LLM_QUEUE_MAX)
+
+_chat_locks = weakref.WeakValueDictionary()
+# The running update's {"lock", "locked", "slot"}: what it holds right now, so
+# a cancel halfway through chat_lock_released's re-acquire releases only that
+_chat_hold = contextvars.ContextVar("chat_hold", default=None)
+
+def chat_lock(chat_id) -> asyncio.Lock:
+    lock = _chat_locks.get(chat_id)
+    if lock is None:
+        lock = _chat_locks[chat_id] = asyncio.Lock()
+    return lock
+
+_received_at = {}  # update_id -> perf_counter() when the webhook got it
+
+def update_kind(update) -> str:
+    if isinstance(update, Update) and update.callback_query:
+        return "callback"
+    message = update.effective_message if isinstance(update, Update) else None
+    text = (message.text or "") if message else ""
+    return text.split()[0].split("@")[0] if text.startswith("/") else "message" if message else "other"
+
+class ChatUpdateProcessor(BaseUpdateProcessor):
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        received = _received_at.pop(getattr(update, "update_id", None), None) or perf_counter()
+        with stage("update", kind=update_kind(update)):
+            if chat is None:
+                await coroutine
+                return
+            lock = chat_lock(chat.id)
+            await lock.acquire()
+            hold = {"lock": lock, "locked": True, "slot": False}
+            try:
+                await fast_lane.acquire()
+                hold["slot"] = True
+                observe("stage_seconds", perf_counter() - received, stage="queue_wait")
+                token = _chat_hold.set(hold)
+                try:
+                    await coroutine
+                finally:
+                    _chat_hold.reset(token)
+            finally:
+                if hold["slot"]:
+                    fast_lane.release()
+                if hold["locked"]:
+                    lock.release()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+@asynccontextmanager
+async def chat_lock_released():
+    """Inside a handler, let the chat's next updates (and other chats' fast
+    work) run while we wait on something slow"""
+    hold = _chat_hold.get()
+    if hold is None:
+        yield
+        return
+    hold["slot"] = False
+    fast_lane.release()
+    hold["locked"] = False
+    hold["lock"].release()
+    try:
+        yield
+    finally:
+        await hold["lock"].acquire()
+        hold["locked"] = True
+        await fast_lane.acquire()
+        hold["slot"] = True
+
+# --- Write-behind Journal ---
+# Profile, item, history and feedback writes go to a local SQLite journal and
+# the handler replies right away; journal_flusher replays them to Supabase in
+# batches (inserts carry an idempotency key, so a replay after a lost response
+# doesn't duplicate rows). Reads overlay still-pending writes, and the last
+# rows read per chat are mirrored locally to answer while Supabase is down.
+JOURNAL_INSERTS = {
+    # op -> (table, conflict column)
+    "add_profile": ("profile", "chat_id"),
+    "add_history": ("outfit_history", "idempotency_key"),
+    "add_history_items": ("outfit_history_items", "history_key,item_id"),
+    "add_feedback": ("feedback", "idempotency_key"),
+}
+JOURNAL_UPDATES = {"update_profile": "profile", "update_item": "items"}
+# op -> RPC (migrations/005, 006). A call waits until everything its chat
+# queued before it has gone out, so it never runs ahead of those rows.
+JOURNAL_CALLS = {"wear_outfit": "wear_outfit", "set_status": "set_item_status"}
+# op -> insert ops it waits on: while one of those fails for a chat, its
+# updates stay queued instead of running against a row that isn't there yet
+JOURNAL_WAITS = {"update_profile": ("add_profile",)}
+REMOTE_ERRORS = (httpx.TransportError,)  # init_db adds postgrest's APIError
+REJECTED_ERRORS = ()  # postgrest's APIError, once init_db imports it: the server refused the write
+MIRROR_ROWS = 20  # history/feedback rows kept per chat
+
+class Journal:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.conn.execute("pragma journal_mode=wal")
+        self.conn.execute("pragma synchronous=normal")
+        self.conn.executescript("""
+            create table if not exists pending (
+                seq integer primary key autoincrement,
+                op text not null,
+                chat_id integer not null,
+                payload text not null,
+                attempts integer not null default 0,
+                last_error text
+            );
+            create index if not exists pending_op_chat on pending (op, chat_id);
+            create table if not exists dead (
+                seq integer primary key, op text, chat_id integer, payload text, attempts integer, last_error text
+            );
+            create table if not exists mirror (
+                kind text not null, chat_id integer not null, data text not null,
+                primary key (kind, chat_id)
+            );
+        """)
+        self.mirror_queue = {}  # (kind, chat_id) -> data read since the last save_mirror()
+        self.mirror_digests = {}  # (kind, chat_id) -> hash of the stored json
+
+    def append(self, op, chat_id, payload):
+        self.conn.execute(
+            "insert into pending (op, chat_id, payload) values (?, ?, ?)",
+            (op, chat_id, json.dumps(payload, ensure_ascii=False, default=str)),
+        )
+        _journal_wakeup.set()
+
+    def pending(self, op=None, chat_id=None, limit=-1):
+        where, params = [], []
+        if op:
+            where.append("op = ?")
+            params.append(op)
+        if chat_id is not None:
+            where.append("chat_id = ?")
+            params.append(chat_id)
+        rows = self.conn.execute(
+            "select seq, op, chat_id, payload, attempts from pending"
+            + (" where " + " and ".join(where) if where else "") + " order by seq limit ?",
+            (*params, limit),
+        ).fetchall()
+        return [{"seq": r[0], "op": r[1], "chat_id": r[2], "payload": json.loads(r[3]), "attempts": r[4]} for r in rows]
+
+    def done(self, entries):
+        self.conn.executemany("delete from pending where seq = ?", [(e["seq"],) for e in entries])
+        stats["journal_flushed"] += len(entries)
+
+    def failed(self, entries, error):
+        """Count a failed attempt; entries out of attempts move to the dead table"""
+        seqs = [(str(error)[:500], e["seq"]) for e in entries]
+        self.conn.executemany("update pending set attempts = attempts + 1, last_error = ? where seq = ?", seqs)
+        dead = self.conn.execute(
+            "insert into dead select seq, op, chat_id, payload, attempts, last_error from pending where attempts >= ?",
+            (JOURNAL_MAX_ATTEMPTS,),
+        ).rowcount
+        if dead:
+            self.conn.execute("delete from pending where attempts >= ?", (JOURNAL_MAX_ATTEMPTS,))
+            stats["journal_dead"] += dead
+            logger.error(f"Journal: {dead} writes gave up after {JOURNAL_MAX_ATTEMPTS} attempts ({error})")
+
+    def size(self):
+        return self.conn.execute("select count(*) from pending").fetchone()[0]
+
+    def mirror_put(self, kind, chat_id, data):
+        self.mirror_queue.pop((kind, chat_id), None)
+        text = json.dumps(data, ensure_ascii=False, default=str)
+        self.mirror_digests[(kind, chat_id)] = hash(text)
+        self.conn.execute("insert or replace into mirror (kind, chat_id, data) values (?, ?, ?)", (kind, chat_id, text))
+
+    def mirror_later(self, kind, chat_id, data):
+        """Queue an entry for the next save_mirror(), so reads never wait on the disk"""
+        self.mirror_queue[(kind, chat_id)] = data
+
+    def save_mirror(self):
+        """Write the queued entries that differ from what is stored"""
+        rows = []
+        while self.mirror_queue:
+            (kind, chat_id), data = self.mirror_queue.popitem()
+            text = json.dumps(data, ensure_ascii=False, default=str)
+            if self.mirror_digests.get((kind, chat_id)) != hash(text):
+                self.mirror_digests[(kind, chat_id)] = hash(text)
+                rows.append((kind, chat_id, text))
+        self.conn.executemany("insert or replace into mirror (kind, chat_id, data) values (?, ?, ?)", rows)
+        stats["mirror_writes"] += len(rows)
+
+    def mirror_get(self, kind, chat_id):
+        if (kind, chat_id) in self.mirror_queue:
+            return self.mirror_queue[(kind, chat_id)]
+        row = self.conn.execute("select data from mirror where kind = ? and chat_id = ?", (kind, chat_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def mirror_update(self, kind, chat_id, change):
+        """Apply change(data) to a mirrored entry, if there is one"""
+        data = self.mirror_get(kind, chat_id)
+        if data is not None:
+            self.mirror_put(kind, chat_id, change(data))
+
+    def close(self):
+        self.conn.close()
+
+journal: Journal = None
+_journal_wakeup = asyncio.Event()
+_journal_flushed = asyncio.Event()  # set after every flusher pass
+_mirror_stale = set()  # chats whose wardrobe changed since it was last mirrored
+_journal_task = None
+_remote_down_at = None
+
+def remote_down() -> bool:
+    return _remote_down_at is not None and monotonic() - _remote_down_at < REMOTE_RETRY_AFTER
+
+def mark_remote(up, error=None):
+    global _remote_down_at
+    if up:
+        if _remote_down_at is not None:
+            logger.info("Supabase reachable again")
+        _remote_down_at = None
+    else:
+        if _remote_down_at is None:
+            logger.warning(f"Supabase unreachable ({error!r}); serving reads from the local mirror")
+        _remote_down_at = monotonic()
+
+async def journal_commit(chat_id):
+    """In write-through mode, wait until the chat's journaled writes have
+    reached Supabase, so a reply never confirms a write that only an
+    ephemeral disk holds. No-op with a persistent journal."""
+    if not JOURNAL_WRITE_THROUGH:
+        return
+    deadline = monotonic() + JOURNAL_COMMIT_TIMEOUT
+    while journal.pending(chat_id=chat_id, limit=1):
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            stats["journal_commit_timeouts"] += 1
+            logger.warning(f"Journal: chat {chat_id} writes not confirmed by Supabase after {JOURNAL_COMMIT_TIMEOUT:.0f}s")
+            return
+        _journal_flushed.clear()
+        _journal_wakeup.set()
+        try:
+            await asyncio.wait_for(_journal_flushed.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+async def read_through(kind, chat_id, fetch):
+    """fetch() from Supabase and mirror the result (written by the flusher);
+    the mirror answers when Supabase can't"""
+    if remote_down():
+        data = journal.mirror_get(kind, chat_id)
+        if data is not None:
+            stats["mirror_reads"] += 1
+            return data
+    try:
+        data = await fetch()
+    except REMOTE_ERRORS as e:
+        mark_remote(False, e)
+        data = journal.mirror_get(kind, chat_id)
+        if data is None:
+            raise
+        stats["mirror_reads"] += 1
+        return data
+    journal.mirror_later(kind, chat_id, data)
+    return data
+
+def status_changes(item, status, reason=None):
+    """Column changes for a status move; a reason is merged into details"""
+    changes = {"status": status}
+    if reason:
+        changes["details"] = {**(item.get("details") or {}), "status_reason": reason}
+    return changes
+
+def with_pending_items(chat_id, rows):
+    """Item rows with the journal's not-yet-flushed updates applied, in order"""
+    rows = {row["id"]: row for row in rows}
+    for entry in journal.pending(chat_id=chat_id):
+        payload = entry["payload"]
+        if entry["op"] == "update_item" and payload["id"] in rows:
+            rows[payload["id"]] = {**rows[payload["id"]], **payload["changes"]}
+        elif entry["op"] == "set_status":
+            for item_id in payload["p_ids"]:
+                if item_id in rows:
+                    row = rows[item_id]
+                    rows[item_id] = {**row, **status_changes(row, payload["p_status"], payload["p_reason"])}
+    return list(rows.values())
+
+async def flush_journal():
+    """Replay one batch of pending writes; returns the number of failed groups.
+
+    Inserts go out as one upsert per table, split in halves when the server
+    rejects one so only the bad rows count a failed attempt; updates to the
+    same row are merged into one; RPC calls go one by one, each only once
+    nothing older is left for its chat. Updates wait while an insert they
+    depend on (JOURNAL_WAITS) is failing for that chat. Only transport errors
+    mark Supabase as down.
+    """
+    entries = journal.pending(limit=JOURNAL_BATCH)
+    inserts, updates, calls = {}, {}, []
+    queued, barred = set(), set()
+    for entry in entries:
+        chat_id = entry["chat_id"]
+        if chat_id in barred:
+            continue
+        if entry["op"] in JOURNAL_CALLS:
+            # Whatever this chat queued after the call waits for a later pass
+            barred.add(chat_id)
+            if chat_id not in queued:
+                calls.append(entry)
+            continue
+        queued.add(chat_id)
+        if entry["op"] in JOURNAL_INSERTS:
+            inserts.setdefault(entry["op"], []).append(entry)
+        else:
+            updates.setdefault((entry["op"], entry["chat_id"], entry["payload"].get("id")), []).append(entry)
+    blocked = {}
+
+    def failed(group, error):
+        journal.failed(group, error)
+        if isinstance(error, httpx.TransportError):
+            mark_remote(False, error)
+        return 1
+
+    async def insert(op, group):
+        table, conflict = JOURNAL_INSERTS[op]
+        try:
+            await db.table(table).upsert(
+                [e["payload"] for e in group], on_conflict=conflict, ignore_duplicates=True
+            ).execute()
+        except REJECTED_ERRORS as e:
+            if len(group) > 1:
+                half = len(group) // 2
+                return await insert(op, group[:half]) + await insert(op, group[half:])
+            blocked.setdefault(op, set()).add(group[0]["chat_id"])
+            return failed(group, e)
+        except Exception as e:
+            blocked.setdefault(op, set()).update(entry["chat_id"] for entry in group)
+            return failed(group, e)
+        journal.done(group)
+        return 0
+
+    failures = 0
+    for op, group in inserts.items():
+        failures += await insert(op, group)
+
+    def waiting(op, chat_id):
+        return any(chat_id in blocked.get(dependency, ()) for dependency in JOURNAL_WAITS.get(op, ()))
+
+    async def apply(op, chat_id, item_id, group):
+        changes = {}
+        for entry in group:
+            changes.update(entry["payload"]["changes"] if item_id else entry["payload"])
+        query = db.table(JOURNAL_UPDATES[op]).update(changes).eq("chat_id", chat_id)
+        if item_id:
+            query = query.eq("id", item_id)
+        try:
+            await query.execute()
+        except Exception as e:
+            return failed(group, e)
+        journal.done(group)
+        return 0
+
+    async def call(entry):
+        try:
+            await db.rpc(JOURNAL_CALLS[entry["op"]], entry["payload"]).execute()
+        except Exception as e:
+            return failed([entry], e)
+        journal.done([entry])
+        return 0
+
+    failures += sum(await asyncio.gather(
+        *(apply(op, chat_id, item_id, group) for (op, chat_id, item_id), group in updates.items()
+          if not waiting(op, chat_id)),
+        *(call(entry) for entry in calls),
+    ))
+    return failures
+
+async def journal_flusher():
+    backoff = 0.0
+    while True:
+        if backoff:
+            await asyncio.sleep(backoff)
+        else:
+            try:
+                await asyncio.wait_for(_journal_wakeup.wait(), JOURNAL_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            if asyncio.current_task().cancelling():
+                # wait_for (3.11) drops a cancel that lands as the wakeup fires
+                raise asyncio.CancelledError
+        _journal_wakeup.clear()
+        try:
+            failures = await flush_journal()
+        except Exception as e:
+            logger.error(f"Journal flush error: {e!r}")
+            failures = 1
+        mirror_wardrobes()
+        _journal_flushed.set()
+        if failures:
+            backoff = min(max(backoff * 2, 1.0), 60.0)
+        else:
+            backoff = 0.0
+            if journal.size():
+                _journal_wakeup.set()
+
+def mirror_wardrobes():
+    """Snapshot wardrobes changed since the last pass into the mirror, and
+    write everything reads have queued for it"""
+    while _mirror_stale:
+        chat_id = _mirror_stale.pop()
+        if chat_id in wardrobes:
+            journal.mirror_later("items", chat_id, list(wardrobes[chat_id].items.values()))
+    journal.save_mirror()
+
+def start_journal():
+    global journal, _journal_task
+    if journal is None:
+        journal = Journal(JOURNAL_PATH or ":memory:")
+        if JOURNAL_WRITE_THROUGH:
+            logger.info("Journal: no persistent JOURNAL_PATH, writes go through to Supabase")
+    _journal_task = asyncio.ensure_future(journal_flusher())
+
+async def stop_journal():
+    """Stop the flusher and make one last attempt to drain the journal"""
+    global _journal_task
+    if _journal_task:
+        # Let a flush in flight unwind before the final one starts
+        _journal_task.cancel()
+        try:
+            await _journal_task
+        except asyncio.CancelledError:
+            pass
+        _journal_task = None
+    if journal:
+        try:
+            await asyncio.wait_for(flush_journal(), 5)
+        except Exception as e:
+            logger.warning(f"Journal final flush error: {e!r}")
+        mirror_wardrobes()
+        if journal.size():
+            logger.warning(f"Journal: {journal.size()} writes left for the next start")
+
 
-def init_db():
+# --- Supabase DB ---
+# Every table carries a chat_id column (see migrations/); all helpers take the
+# chat as their first argument and never read or write outside it.
+db = None  # supabase AsyncClient
+TENANT_TABLES = ["profile", "items", "outfit_history", "feedback", "packing_lists"]
+
+def import_supabase():
+    global REMOTE_ERRORS, REJECTED_ERRORS
+    with stage("import_supabase"):
+        from supabase import acreate_client, AsyncClientOptions
+        from postgrest.exceptions import APIError
+    REMOTE_ERRORS = (httpx.TransportError, APIError)
+    REJECTED_ERRORS = (APIError,)
+    return acreate_client, AsyncClientOptions
+
+async def init_db():
     global db
-    db = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-def db_get_profile():
-    result = db.table("profile").select("*").eq("id", 1).execute()
-    if result.data:
-        return result.data[0]
-    default = {
-        "id": 1,
-        "city": "Saltillo, Coahuila",
-        "age": 36, "height_cm": 162, "weight_kg": 75,
-        "target_weight_kg": 60,
-        "skin_tone": "moreno claro / light medium",
-        "undertone": "cálido-neutral, más dorado que rosado",
-        "hair": "al hombro",
-        "identity": "Mujer queer, prefiere vestir masculino/andrógino",
-        "style_notes": "Casual urbano, edgy pero simple. Colores oscuros y neutros.",
-        "daily_enabled": False
-    }
-    db.table("profile").insert(default).execute()
-    return default
+    acreate_client, AsyncClientOptions = await asyncio.to_thread(import_supabase)
+    db = await acreate_client(
+        SUPABASE_URL, SUPABASE_KEY,
+        options=AsyncClientOptions(httpx_client=pooled_http_client("supabase", timeout=30, http2=True)),
+    )
 
-def db_update_profile(**kwargs):
-    db.table("profile").update(kwargs).eq("id", 1).execute()
+async def adopt_legacy_rows():
+    """Hand rows from the single-user days (chat_id NULL) to OWNER_CHAT_ID"""
+    if not OWNER_CHAT_ID:
+        return
+    for table in TENANT_TABLES:
+        result = await db.table(table).update({"chat_id": OWNER_CHAT_ID}).is_("chat_id", "null").execute()
+        if result.data:
+            logger.info(f"Assigned {len(result.data)} legacy {table} rows to chat {OWNER_CHAT_ID}")
+
+OWNER_PROFILE = {
+    "age": 36, "height_cm": 162, "weight_kg": 75,
+    "target_weight_kg": 60,
+    "skin_tone": "moreno claro / light medium",
+    "undertone": "cálido-neutral, más dorado que rosado",
+    "hair": "al hombro",
+    "identity": "Mujer queer, prefiere vestir masculino/andrógino",
+    "style_notes": "Casual urbano, edgy pero simple. Colores oscuros y neutros.",
+}
+
+async def db_get_profile(chat_id):
+    async def fetch():
+        return (await db.table("profile").select("*").eq("chat_id", chat_id).execute()).data or []
+    rows = await read_through("profile", chat_id, fetch)
+    if rows:
+        profile = rows[0]
+    else:
+        added = journal.pending("add_profile", chat_id)
+        profile = added[0]["payload"] if added else None
+    if profile is None:
+        profile = {
+            "chat_id": chat_id,
+            "city": "Saltillo, Coahuila",
+            **(OWNER_PROFILE if chat_id == OWNER_CHAT_ID else {}),
+            "daily_enabled": False
+        }
+        journal.append("add_profile", chat_id, profile)
+        journal.mirror_put("profile", chat_id, [profile])
+        await journal_commit(chat_id)
+    for entry in journal.pending("update_profile", chat_id):
+        profile = {**profile, **entry["payload"]}
+    return profile
+
+async def db_get_profiles(daily_only=False):
+    query = db.table("profile").select("*")
+    if daily_only:
+        query = query.eq("daily_enabled", True)
+    return (await query.execute()).data or []
+
+async def db_update_profile(chat_id, **kwargs):
+    journal.append("update_profile", chat_id, kwargs)
+    journal.mirror_update("profile", chat_id, lambda rows: [{**rows[0], **kwargs}] if rows else rows)
+    await journal_commit(chat_id)
+
+DEFAULT_TIMEZONE = timezone(timedelta(hours=TIMEZONE_OFFSET))
+
+def parse_timezone(name):
+    """IANA zone name ('America/Monterrey') → tzinfo; ValueError if unknown"""
+    try:
+        return ZoneInfo(name.strip())
+    except (ZoneInfoNotFoundError, ValueError):
+        raise ValueError(f"Zona horaria desconocida: {name}")
 
-def db_add_item(category, name, details=None, location=None):
-    item = {
+def timezone_name(name):
+    return parse_timezone(name).key
+
+def profile_timezone(profile):
+    """The profile's own timezone, or TIMEZONE_OFFSET when it has none (or a bad one)"""
+    try:
+        return parse_timezone(profile["timezone"]) if profile.get("timezone") else DEFAULT_TIMEZONE
+    except ValueError:
+        return DEFAULT_TIMEZONE
+
+def _new_item(chat_id, category, name, details=None, location=None):
+    return {
+        "chat_id": chat_id,
         "category": category,
         "name": name,
         "status": "clean",
@@ -71,142 +1255,846 @@ def db_add_item(category, name, details=None, location=None):
         "times_worn": 0,
         "last_worn": None,
     }
-    result = db.table("items").insert(item).execute()
-    return result.data[0] if result.data else None
-
-def db_get_items(status=None, category=None):
-    query = db.table("items").select("*")
-    if status:
-        query = query.eq("status", status)
-    if category:
-        query = query.eq("category", category)
-    return query.order("category").execute().data or []
 
-def db_update_item(item_id, **kwargs):
-    db.table("items").update(kwargs).eq("id", item_id).execute()
+async def get_wardrobe(chat_id) -> Wardrobe:
+    store = wardrobes.get(chat_id)
+    if store is None:
+        store = wardrobes[chat_id] = Wardrobe()
+    if not store.loaded:
+        await load_wardrobe(chat_id)
+    return store
+
+async def db_add_item(chat_id, category, name, details=None, location=None):
+    store = await get_wardrobe(chat_id)
+    result = await db.table("items").insert(_new_item(chat_id, category, name, details, location)).execute()
+    if not result.data:
+        return None
+    store.put(result.data[0])
+    _mirror_stale.add(chat_id)
+    response_cache.clear(chat_id)
+    return result.data[0]
+
+async def db_add_items(chat_id, rows, chunk_size=None):
+    """Insert many (category, name, details) rows with multi-row inserts.
+
+    Returns one (item, error) pair per row, in order. A chunk the server
+    rejects is retried row by row so one bad row doesn't sink its neighbours.
+    A chunk whose answer got lost may have been inserted anyway, so it isn't
+    retried (items carry no key to make that safe): its rows are reported
+    as unconfirmed.
+    """
+    chunk_size = chunk_size or BULK_CHUNK_SIZE
+    store = await get_wardrobe(chat_id)
+    response_cache.clear(chat_id)
+    _mirror_stale.add(chat_id)
+    results = []
+    for start in range(0, len(rows), chunk_size):
+        chunk = [_new_item(chat_id, *row) for row in rows[start:start + chunk_size]]
+        try:
+            inserted = (await db.table("items").insert(chunk).execute()).data or []
+        except REJECTED_ERRORS as e:
+            logger.warning(f"Bulk insert chunk rejected, retrying row by row: {e}")
+            for row in chunk:
+                try:
+                    result = await db.table("items").insert(row).execute()
+                except Exception as e:
+                    results.append((None, str(e)))
+                    continue
+                if result.data:
+                    store.put(result.data[0])
+                    results.append((result.data[0], None))
+                else:
+                    results.append((None, "sin respuesta"))
+            continue
+        except Exception as e:
+            logger.warning(f"Bulk insert chunk lost ({e!r}), not retrying")
+            results += [(None, "sin confirmación; revisa /closet antes de reintentarla")] * len(chunk)
+            continue
+        # Match what came back to the rows sent; nothing is sent twice
+        returned = {}
+        for item in inserted:
+            store.put(item)
+            returned.setdefault((item["category"], item["name"]), []).append(item)
+        for row in chunk:
+            matches = returned.get((row["category"], row["name"]))
+            results.append((matches.pop(0), None) if matches else (None, "sin confirmación; revisa /closet"))
+    return results
 
-def db_find_item(search):
-    """Find item by partial ID or name match"""
-    # Try by ID first
+async def load_wardrobe(chat_id):
+    store = wardrobes.setdefault(chat_id, Wardrobe())
+    version = store.version
+
+    async def fetch():
+        return (await db.table("items").select("*").eq("chat_id", chat_id).execute()).data or []
+    rows = await read_through("items", chat_id, fetch)
+    # A write landed while we were fetching; the snapshot may predate it
+    if store.loaded and store.version != version:
+        return False
+    store.load(with_pending_items(chat_id, rows))
+    return True
+
+async def db_get_items(chat_id, status=None, category=None):
+    return (await get_wardrobe(chat_id)).select(status, category)
+
+async def db_update_item(chat_id, item_id, **kwargs):
+    store = await get_wardrobe(chat_id)
+    journal.append("update_item", chat_id, {"id": item_id, "changes": kwargs})
+    store.patch(item_id, kwargs)
+    _mirror_stale.add(chat_id)
+    if kwargs.keys() & {"status", "name", "category", "details"}:
+        response_cache.clear(chat_id)
+    await journal_commit(chat_id)
+
+async def db_set_status(chat_id, item_ids, status, reason=None):
+    """Move many items to status with one set-based update (reason is merged
+    into details server-side). Returns how many items changed."""
+    store = await get_wardrobe(chat_id)
+    item_ids = [item_id for item_id in dict.fromkeys(item_ids) if store.get(item_id)]
+    if not item_ids:
+        return 0
+    journal.append("set_status", chat_id, {
+        "p_chat_id": chat_id, "p_ids": item_ids, "p_status": status, "p_reason": reason or None,
+    })
+    for item_id in item_ids:
+        store.patch(item_id, status_changes(store.get(item_id), status, reason))
+    _mirror_stale.add(chat_id)
+    response_cache.clear(chat_id)
+    await journal_commit(chat_id)
+    return len(item_ids)
+
+async def db_find_item(chat_id, search):
+    """Find item by ID or best name/details match"""
+    return (await get_wardrobe(chat_id)).find(search)
+
+async def db_find_items(chat_id, search, limit=5):
+    """Ranked candidates for a name/details search"""
+    return (await get_wardrobe(chat_id)).search(search, limit)
+
+async def db_find_leading(chat_id, words):
+    """Item named by the leading words of a command, plus the leftover words"""
+    return (await get_wardrobe(chat_id)).find_leading(words)
+
+async def db_find_many(chat_id, text):
+    """Resolve several ids/names in one pass: [(ref, item or None)]"""
+    return (await get_wardrobe(chat_id)).find_many(text)
+
+async def reconcile_wardrobe_job(context: ContextTypes.DEFAULT_TYPE):
+    """Pick up edits made to the items table outside the bot, for every loaded chat"""
+    chats = [chat_id for chat_id, store in wardrobes.items() if store.loaded]
+    if not chats:
+        return
+    versions = {chat_id: wardrobes[chat_id].version for chat_id in chats}
     try:
-        item_id = int(search)
-        result = db.table("items").select("*").eq("id", item_id).execute()
-        if result.data:
-            return result.data[0]
-    except ValueError:
-        pass
-    # Search by name
-    result = db.table("items").select("*").ilike("name", f"%{search}%").execute()
-    if result.data:
-        return result.data[0]
-    return None
-
-def db_get_history(limit=7):
-    result = db.table("outfit_history").select("*").order("created_at", desc=True).limit(limit).execute()
-    return result.data or []
-
-def db_add_history(outfit_text, occasion):
-    db.table("outfit_history").insert({
-        "outfit_text": outfit_text,
-        "occasion": occasion,
-    }).execute()
-
-def db_add_feedback(text):
-    db.table("feedback").insert({"text": text}).execute()
+        rows = (await db.table("items").select("*").in_("chat_id", chats).execute()).data or []
+    except Exception as e:
+        logger.warning(f"Wardrobe reconcile error: {e}")
+        return
+    by_chat = {chat_id: [] for chat_id in chats}
+    for row in rows:
+        by_chat.setdefault(row["chat_id"], []).append(row)
+    changed = 0
+    for chat_id in chats:
+        store = wardrobes[chat_id]
+        # A write landed while we were fetching; the snapshot may predate it
+        if store.version != versions[chat_id]:
+            continue
+        before = store.items
+        journal.mirror_put("items", chat_id, by_chat[chat_id])
+        store.load(with_pending_items(chat_id, by_chat[chat_id]))
+        changed += sum(1 for k in before.keys() | store.items.keys() if before.get(k) != store.items.get(k))
+    if changed:
+        logger.info(f"Wardrobe reconcile: {changed} items changed outside the bot")
+
+def _with_pending_rows(op, chat_id, rows, limit):
+    """Newest first: journaled rows not yet in Supabase, then the fetched ones"""
+    seen = {r.get("idempotency_key") for r in rows}
+    pending = [e["payload"] for e in journal.pending(op, chat_id) if e["payload"]["idempotency_key"] not in seen]
+    return (pending[::-1] + rows)[:limit]
+
+def _journal_row(chat_id, **fields):
+    return {
+        "chat_id": chat_id, **fields,
+        "idempotency_key": uuid.uuid4().hex,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    }
 
-def db_get_feedback(limit=10):
-    result = db.table("feedback").select("*").order("created_at", desc=True).limit(limit).execute()
-    return result.data or []
+async def db_get_history(chat_id, limit=7):
+    async def fetch():
+        result = await db.table("outfit_history").select("*").eq("chat_id", chat_id).order("created_at", desc=True).limit(limit).execute()
+        return result.data or []
+    rows = _with_pending_rows("add_history", chat_id, await read_through("history", chat_id, fetch), limit)
+    # A /usar still in the journal counts as worn, so a restart can't double it
+    worn = {e["payload"]["p_history_key"]: e["payload"]["p_day"] for e in journal.pending("wear_outfit", chat_id)}
+    return [
+        {**r, "worn_on": worn[r["idempotency_key"]]} if not r.get("worn_on") and r.get("idempotency_key") in worn else r
+        for r in rows
+    ]
+
+async def db_add_history(chat_id, outfit_text, occasion):
+    """Save a suggestion plus one outfit_history_items row per wardrobe item it names"""
+    store = await get_wardrobe(chat_id)
+    row = _journal_row(chat_id, outfit_text=outfit_text, occasion=occasion)
+    journal.append("add_history", chat_id, row)
+    for slot, item_id in outfit_item_ids(outfit_text):
+        if store.get(item_id):
+            journal.append("add_history_items", chat_id, {
+                "chat_id": chat_id, "history_key": row["idempotency_key"], "item_id": item_id, "slot": slot,
+            })
+    journal.mirror_update("history", chat_id, lambda rows: [row] + rows[:MIRROR_ROWS - 1])
+    await journal_commit(chat_id)
+    return row
+
+async def db_wear_outfit(chat_id, history, day):
+    """Count a saved suggestion as worn on day: its items' times_worn and
+    last_worn are bumped in one server-side update. Returns those items, or
+    None if the suggestion was already worn."""
+    if history.get("worn_on"):
+        return None
+    store = await get_wardrobe(chat_id)
+    items = [store.get(item_id) for _, item_id in outfit_item_ids(history.get("outfit_text"))]
+    items = [item for item in items if item]
+    journal.append("wear_outfit", chat_id, {
+        "p_chat_id": chat_id, "p_history_key": history["idempotency_key"], "p_day": day.isoformat(),
+    })
+    for item in items:
+        store.patch(item["id"], {"times_worn": (item.get("times_worn") or 0) + 1, "last_worn": day.isoformat()})
+    key = history["idempotency_key"]
+    history["worn_on"] = day.isoformat()
+    journal.mirror_update("history", chat_id, lambda rows: [
+        {**r, "worn_on": day.isoformat()} if r.get("idempotency_key") == key else r for r in rows
+    ])
+    _mirror_stale.add(chat_id)
+    response_cache.clear(chat_id)
+    await journal_commit(chat_id)
+    return items
+
+async def db_get_daily_outfits(chat_ids, days):
+    """Stored daily runs for these chats and local dates, keyed by (chat_id, day)"""
+    result = await db.table("daily_outfits").select("*").in_("chat_id", list(chat_ids)).in_("day", list(days)).execute()
+    return {(r["chat_id"], r["day"]): r for r in result.data or []}
+
+async def db_save_daily_outfit(run):
+    await db.table("daily_outfits").upsert({
+        "chat_id": run["chat_id"],
+        "day": run["day"],
+        "outfit": run["outfit"],
+        "status": run["status"],
+        "attempts": run["attempts"],
+        "error": run["error"],
+    }, on_conflict="chat_id,day").execute()
+
+async def db_add_feedback(chat_id, text):
+    row = _journal_row(chat_id, text=text)
+    journal.append("add_feedback", chat_id, row)
+    journal.mirror_update("feedback", chat_id, lambda rows: [row] + rows[:MIRROR_ROWS - 1])
+    await journal_commit(chat_id)
+
+async def db_get_feedback(chat_id, limit=10):
+    async def fetch():
+        result = await db.table("feedback").select("*").eq("chat_id", chat_id).order("created_at", desc=True).limit(limit).execute()
+        return result.data or []
+    return _with_pending_rows("add_feedback", chat_id, await read_through("feedback", chat_id, fetch), limit)
 
 # --- Packing Lists ---
-def db_get_lists():
-    result = db.table("packing_lists").select("*").order("name").execute()
+async def db_get_lists(chat_id):
+    result = await db.table("packing_lists").select("*").eq("chat_id", chat_id).order("name").execute()
     return result.data or []
 
-def db_get_list(name):
-    result = db.table("packing_lists").select("*").eq("name", name.lower()).execute()
+async def db_get_list(chat_id, name):
+    result = await db.table("packing_lists").select("*").eq("chat_id", chat_id).eq("name", name.lower()).execute()
     return result.data[0] if result.data else None
 
-def db_create_list(name, description=""):
-    existing = db_get_list(name)
-    if existing:
-        return None
-    result = db.table("packing_lists").insert({
-        "name": name.lower(), "description": description, "items": []
-    }).execute()
+async def db_create_list(chat_id, name, description=""):
+    """Insert unless (chat_id, name) exists; None when it already did"""
+    result = await db.table("packing_lists").upsert(
+        {"chat_id": chat_id, "name": name.lower(), "description": description, "items": []},
+        on_conflict="chat_id,name", ignore_duplicates=True,
+    ).execute()
     return result.data[0] if result.data else None
 
-def db_update_list_items(name, items):
-    db.table("packing_lists").update({"items": items}).eq("name", name.lower()).execute()
-
-def db_delete_list(name):
-    result = db.table("packing_lists").delete().eq("name", name.lower()).execute()
+# Item edits run server-side (migrations/003_packing_list_rpcs.sql): one
+# round-trip each, and concurrent edits can't overwrite one another.
+async def db_add_list_items(chat_id, name, items):
+    """Append items; returns the new list, or None if the list doesn't exist"""
+    result = await db.rpc("list_add_items", {"p_chat_id": chat_id, "p_name": name.lower(), "p_items": items}).execute()
+    return result.data
+
+async def db_remove_list_items(chat_id, name, positions):
+    """Remove 1-based positions; returns {"items", "removed"}, or None if the list doesn't exist"""
+    result = await db.rpc(
+        "list_remove_items", {"p_chat_id": chat_id, "p_name": name.lower(), "p_positions": sorted(set(positions))}
+    ).execute()
+    return result.data
+
+async def db_move_list_item(chat_id, name, src, dst):
+    """Move position src to dst (1-based); returns {"items", "moved"}, or None if the list doesn't exist"""
+    result = await db.rpc(
+        "list_move_item", {"p_chat_id": chat_id, "p_name": name.lower(), "p_from": src, "p_to": dst}
+    ).execute()
+    return result.data
+
+async def db_delete_list(chat_id, name):
+    result = await db.table("packing_lists").delete().eq("chat_id", chat_id).eq("name", name.lower()).execute()
     return bool(result.data)
 
 
 # --- Weather ---
-def get_weather(city: str) -> str:
+# city -> (fetched_at, wttr.in payload); entries older than WEATHER_TTL are
+# served stale for up to WEATHER_MAX_STALE while a refresh runs in the background
+_weather_cache = {}
+_weather_inflight = {}
+
+async def fetch_weather_data(city: str) -> dict:
+    encoded = urllib.parse.quote(city)
+    url = f"https://wttr.in/{encoded}?format=j1"
+    headers = {"User-Agent": "curl/7.68.0", "Accept": "application/json"}
+    resp = await http.get(url, headers=headers)
+    resp.raise_for_status()
+    return resp.json()
+
+def format_weather(city: str, data: dict) -> str:
+    current = data["current_condition"][0]
+    temp = current["temp_C"]
+    feels = current["FeelsLikeC"]
+    desc_list = current.get("lang_es", current.get("weatherDesc", [{}]))
+    desc = desc_list[0].get("value", "") if desc_list else ""
+    humidity = current["humidity"]
+    forecast = data["weather"][0]
+    max_t = forecast["maxtempC"]
+    min_t = forecast["mintempC"]
+    hourly = forecast.get("hourly", [])
+    rain = hourly[4].get("chanceofrain", "0") if len(hourly) > 4 else "0"
+    return (
+        f"Clima en {city}: {desc}, {temp}°C (sensación {feels}°C), "
+        f"min {min_t}°C / max {max_t}°C, humedad {humidity}%, lluvia {rain}%"
+    )
+
+async def refresh_weather(city: str) -> dict:
+    """Fetch and cache weather for a city, sharing one request between concurrent callers"""
+    key = city.strip().lower()
+    task = _weather_inflight.get(key)
+    if task is None:
+        async def fetch():
+            try:
+                data = await fetch_weather_data(city)
+                format_weather(city, data)  # reject payloads we can't render
+                _weather_cache[key] = (monotonic(), data)
+                return data
+            finally:
+                _weather_inflight.pop(key, None)
+        task = _weather_inflight[key] = asyncio.ensure_future(fetch())
+    return await asyncio.shield(task)
+
+def _refresh_weather_in_background(city: str):
+    async def run():
+        try:
+            await refresh_weather(city)
+        except Exception as e:
+            logger.warning(f"Weather refresh error for {city}: {e}")
+    if city.strip().lower() not in _weather_inflight:
+        spawn(run())
+
+async def get_weather(city: str) -> str:
+    entry = _weather_cache.get(city.strip().lower())
+    if entry:
+        age = monotonic() - entry[0]
+        if age < WEATHER_TTL:
+            stats["weather_hit"] += 1
+            return format_weather(city, entry[1])
+        if age < WEATHER_MAX_STALE:
+            stats["weather_stale"] += 1
+            _refresh_weather_in_background(city)
+            return format_weather(city, entry[1])
+    stats["weather_miss"] += 1
     try:
-        encoded = urllib.parse.quote(city)
-        url = f"https://wttr.in/{encoded}?format=j1"
-        req = urllib.request.Request(url, headers={"User-Agent": "curl/7.68.0", "Accept": "application/json"})
-        with urllib.request.urlopen(req, timeout=15) as resp:
-            data = json.loads(resp.read())
-        current = data["current_condition"][0]
-        temp = current["temp_C"]
-        feels = current["FeelsLikeC"]
-        desc_list = current.get("lang_es", current.get("weatherDesc", [{}]))
-        desc = desc_list[0].get("value", "") if desc_list else ""
-        humidity = current["humidity"]
-        forecast = data["weather"][0]
-        max_t = forecast["maxtempC"]
-        min_t = forecast["mintempC"]
-        hourly = forecast.get("hourly", [])
-        rain = hourly[4].get("chanceofrain", "0") if len(hourly) > 4 else "0"
-        return (
-            f"Clima en {city}: {desc}, {temp}°C (sensación {feels}°C), "
-            f"min {min_t}°C / max {max_t}°C, humedad {humidity}%, lluvia {rain}%"
-        )
+        return format_weather(city, await refresh_weather(city))
     except Exception as e:
         logger.warning(f"Weather error for {city}: {e}")
+        stats["weather_error"] += 1
+        if entry:
+            return format_weather(city, entry[1])
         return f"(clima no disponible para {city})"
 
+def weather_conditions(city: str):
+    """Cached feels-like and max rain chance for today as numbers, or None"""
+    entry = _weather_cache.get(city.strip().lower())
+    if not entry:
+        return None
+    try:
+        feels = int(entry[1]["current_condition"][0]["FeelsLikeC"])
+        hourly = entry[1]["weather"][0].get("hourly", [])
+        rain = max((int(h.get("chanceofrain", 0)) for h in hourly), default=0)
+    except (KeyError, IndexError, ValueError):
+        return None
+    return {"feels": feels, "rain": rain}
+
+def forecast_days(city: str, days: int):
+    """Cached daily forecast as [{date, min, max, rain, desc}], up to days
+    long (wttr.in sends 3), or [] if there is none"""
+    entry = _weather_cache.get(city.strip().lower())
+    if not entry:
+        return []
+    forecast = []
+    try:
+        for day in entry[1]["weather"][:days]:
+            hourly = day.get("hourly", [])
+            midday = hourly[len(hourly) // 2] if hourly else {}
+            desc_list = midday.get("lang_es", midday.get("weatherDesc", [{}]))
+            forecast.append({
+                "date": day.get("date", ""),
+                "min": int(day["mintempC"]),
+                "max": int(day["maxtempC"]),
+                "rain": max((int(h.get("chanceofrain", 0)) for h in hourly), default=0),
+                "desc": desc_list[0].get("value", "") if desc_list else "",
+            })
+    except (KeyError, IndexError, ValueError):
+        return []
+    return forecast
+
+def weather_bucket(city: str) -> str:
+    """Coarse weather class for cache keys: feels-like temp in 5°C steps + rain flag"""
+    conditions = weather_conditions(city)
+    if not conditions:
+        return "?"
+    return f"{conditions['feels'] // 5 * 5}C" + ("-lluvia" if conditions["rain"] >= 50 else "")
+
+async def warm_weather_job(context: ContextTypes.DEFAULT_TYPE):
+    """Keep every profile's current city in the cache"""
+    cities = {fold_text(p["city"]): p["city"] for p in await db_get_profiles() if p.get("city")}
+    for city in cities.values():
+        try:
+            await refresh_weather(city)
+        except Exception as e:
+            logger.warning(f"Weather warm-up error for {city}: {e}")
+
 
 # --- AI Context Builder ---
-def build_ai_context():
-    profile = db_get_profile()
-    available = db_get_items(status="clean")
-    dirty = db_get_items(status="dirty")
-    history = db_get_history(7)
-    feedback = db_get_feedback(10)
-
-    context = {
-        "profile": {
-            "city": profile.get("city"),
-            "age": profile.get("age"),
-            "height_cm": profile.get("height_cm"),
-            "weight_kg": profile.get("weight_kg"),
-            "target_weight_kg": profile.get("target_weight_kg"),
-            "skin_tone": profile.get("skin_tone"),
-            "undertone": profile.get("undertone"),
-            "hair": profile.get("hair"),
-            "identity": profile.get("identity"),
-            "style_notes": profile.get("style_notes"),
-        },
-        "available_items": [
-            {
-                "id": i["id"], "name": i["name"], "category": i["category"],
-                "details": i.get("details", {}),
-                "location": i.get("location"),
-            }
-            for i in available
-        ],
-        "dirty_items": [f"{i['name']} ({i['category']})" for i in dirty],
-        "recent_outfits": [{"occasion": h.get("occasion"), "outfit": h.get("outfit_text"), "date": h.get("created_at")} for h in history],
-        "feedback": [f.get("text") for f in feedback],
+async def _timed(timings, source, coro):
+    start = perf_counter()
+    try:
+        with stage(f"context_{source}"):
+            return await coro
+    finally:
+        timings[source] = (perf_counter() - start) * 1000
+
+async def gather_context(chat_id, city_override=None):
+    """Fetch everything the prompt needs concurrently, with per-source timings in ms"""
+    timings = {}
+    start = perf_counter()
+    profile_task = asyncio.ensure_future(_timed(timings, "profile", db_get_profile(chat_id)))
+
+    async def city_weather():
+        # With an explicit city the weather fetch doesn't wait for the profile
+        city = city_override or (await profile_task).get("city", "Saltillo, Coahuila")
+        return city, await _timed(timings, "weather", get_weather(city))
+
+    (city, weather), profile, items, history, feedback = await asyncio.gather(
+        city_weather(),
+        profile_task,
+        _timed(timings, "items", db_get_items(chat_id, status=("clean", "dirty"))),
+        _timed(timings, "history", db_get_history(chat_id, 7)),
+        _timed(timings, "feedback", db_get_feedback(chat_id, 10)),
+    )
+    timings["total"] = (perf_counter() - start) * 1000
+    logger.info("Context timings: " + ", ".join(f"{k}={v:.0f}ms" for k, v in timings.items()))
+    return {
+        "profile": profile,
+        "city": city,
+        "weather": weather,
+        "available": [i for i in items if i["status"] == "clean"],
+        "dirty": [i for i in items if i["status"] == "dirty"],
+        "history": history,
+        "feedback": feedback,
+        "now": datetime.now(profile_timezone(profile)),
+        "rotation": (await get_wardrobe(chat_id)).rotation(),
+        "timings": timings,
+    }
+
+PROFILE_FIELDS = [
+    ("city", "ciudad"), ("age", "edad"), ("height_cm", "estatura_cm"),
+    ("weight_kg", "peso_kg"), ("target_weight_kg", "meta_kg"),
+    ("skin_tone", "tono"), ("undertone", "subtono"), ("hair", "cabello"),
+    ("identity", "identidad"), ("style_notes", "estilo"),
+]
+MIN_ITEMS_PER_CATEGORY = 3
+
+def estimate_tokens(text: str) -> int:
+    """Rough Gemini token count (~4 characters per token)"""
+    return len(text) // 4 + 1
+
+def item_line(item) -> str:
+    details = item.get("details") or {}
+    parts = [f"{k}:{v}" for k, v in details.items() if k != "status_reason" and v]
+    return f"{item['id']}|{item['name']}" + (f"|{', '.join(parts)}" if parts else "")
+
+def outfit_digest(text, limit=160) -> str:
+    """One-line summary of a past suggestion: its title and garment lines"""
+    lines = [l.strip() for l in (text or "").splitlines() if l.strip() and not l.strip().startswith(("💡", "⚠️"))]
+    digest = "; ".join(lines)
+    return digest if len(digest) <= limit else digest[:limit - 1] + "…"
+
+ITEM_REF = re.compile(r"\[#?(\d+)\]")
+
+def outfit_item_ids(text):
+    """(slot emoji, item id) pairs from the garment lines of a suggestion, first mention only"""
+    slots = [emoji for emoji, *_ in OUTFIT_SLOTS]
+    pairs, seen = [], set()
+    for line in (text or "").splitlines():
+        line = line.strip()
+        slot = next((emoji for emoji in slots if line.startswith(emoji)), None)
+        for item_id in map(int, ITEM_REF.findall(line)) if slot else ():
+            if item_id not in seen:
+                seen.add(item_id)
+                pairs.append((slot, item_id))
+    return pairs
+
+def history_line(entry) -> str:
+    """A past suggestion as the ids it used; older entries without ids fall back to a digest"""
+    ids = [str(item_id) for _, item_id in outfit_item_ids(entry.get("outfit_text"))]
+    summary = "ids " + ",".join(ids) if ids else outfit_digest(entry.get("outfit_text"))
+    return f"- {(entry.get('created_at') or '')[:10]} {entry.get('occasion') or ''}: {summary}"
+
+def build_ai_context(ctx, budget=None):
+    """Compact wardrobe context for the prompt, pruned to a token budget.
+
+    Clean items go out as 'id|name|details' rows grouped by category, past
+    outfits as the item ids they used. Only ctx["candidates"] (see shortlist) are
+    listed when set. If the result is over budget, the lowest-ranked items
+    are dropped from the largest categories first, never going below
+    MIN_ITEMS_PER_CATEGORY in any category.
+    """
+    budget = budget or PROMPT_TOKEN_BUDGET
+    profile = ctx["profile"]
+    history = ctx["history"]
+    by_category = ctx.get("candidates") or shortlist(ctx, per_category=len(ctx["available"]))
+    rows = {cat: [item_line(i) for i in items] for cat, items in by_category.items()}
+    categories = sorted(rows, key=lambda c: ALL_CATEGORIES.index(c) if c in ALL_CATEGORIES else len(ALL_CATEGORIES))
+    pruned = Counter(i["category"] for i in ctx["available"])
+    pruned.subtract({cat: len(items) for cat, items in by_category.items()})
+    pruned = {cat: n for cat, n in pruned.items() if n > 0 and cat in rows}
+
+    header = [
+        "PERFIL: " + "; ".join(f"{label}={profile[key]}" for key, label in PROFILE_FIELDS if profile.get(key)),
+        "",
+        "DISPONIBLE (limpio, ya filtrado por clima, uso reciente"
+        + (f" y metal: {ctx['metal']}" if ctx.get("metal") else "") + ") — id|nombre|detalles:",
+    ]
+    footer = ["", "SUCIO: " + (", ".join(f"{i['name']} ({i['category']})" for i in ctx["dirty"]) or "nada")]
+    footer += ["", "OUTFITS RECIENTES (no repetir):"]
+    footer += [history_line(h) for h in history] or ["- ninguno"]
+    listed = {i["id"] for items in by_category.values() for i in items}
+    least_worn = [str(i["id"]) for i in ctx.get("rotation", {}).get("least_worn", []) if i["id"] in listed]
+    if least_worn:
+        footer += ["", "MENOS USADOS (dales salida si combinan): " + ",".join(least_worn)]
+    feedback = [f.get("text") for f in ctx["feedback"] if f.get("text")]
+    if feedback:
+        footer += ["", "FEEDBACK:"] + [f"- {f}" for f in feedback]
+
+    size = estimate_tokens("\n".join(header + footer))
+    size += sum(estimate_tokens(f"[{c}]") + sum(estimate_tokens(r) for r in rows[c]) for c in categories)
+    while size > budget:
+        cat = max(categories, key=lambda c: len(rows[c]))
+        if len(rows[cat]) <= MIN_ITEMS_PER_CATEGORY:
+            break
+        size -= estimate_tokens(rows[cat].pop())
+        pruned[cat] = pruned.get(cat, 0) + 1
+
+    body = []
+    for cat in categories:
+        body.append(f"[{cat}]" + (f" (+{pruned[cat]} omitidas)" if cat in pruned else ""))
+        body.extend(rows[cat])
+    text = "\n".join(header + body + footer)
+    ctx["prompt_stats"] = {
+        "items": sum(len(r) for r in rows.values()),
+        "pruned": sum(pruned.values()),
+        "tokens": estimate_tokens(text),
     }
-    return json.dumps(context, ensure_ascii=False, indent=2)
+    return text
+
+
+# --- Local Outfit Engine ---
+# Deterministic pre-selection ahead of the LLM: every clean item gets a score
+# (days since last worn, not in recent outfits, fits today's weather) and only
+# the best OUTFIT_CANDIDATES per category go into the prompt. Jewelry and
+# watches are narrowed to one metal, and layers are dropped when it's warm.
+# local_outfit() assembles a full outfit from the same shortlist when Gemini
+# is down, slow, or LOCAL_ONLY is set.
+OUTFIT_SLOTS = [
+    # (emoji, categories, how many, required)
+    ("🩲", ["underwear"], 1, True),
+    ("🧦", ["socks"], 1, True),
+    ("👖", ["pantalones"], 1, True),
+    ("👕", ["tops"], 1, True),
+    ("👟", ["calzado"], 1, True),
+    ("🧥", ["capas"], 1, False),
+    ("🧢", ["gorras"], 1, False),
+    ("⌚", ["relojes", "smartwatch_bands"], 1, False),
+    ("👂", ["plugs"], 1, False),
+    ("💍", ["anillos"], 2, False),
+]
+METAL_CATEGORIES = {"relojes", "smartwatch_bands", "anillos", "cadenas", "pulseras", "plugs"}
+METAL_WORDS = {
+    "dorado": ("dorado", "dorada", "gold", "oro"),
+    "plateado": ("plata", "plateado", "plateada", "silver", "acero", "steel", "titanio"),
+}
+WARM_WORDS = ("sudadera", "hoodie", "sueter", "chamarra", "lana", "manga larga", "botas", "termic", "fleece", "pana")
+COOL_WORDS = ("short", "manga corta", "tank", "sandalia", "lino", "sin manga")
+WET_WORDS = ("gamuza", "suede", "lona", "canvas")
+LAYER_BELOW = 18  # feels-like °C under which a layer (capas) is offered
+COLD_BELOW = 14
+HOT_ABOVE = 26
+
+def item_text(item) -> str:
+    return fold_text(" ".join([item["name"]] + [str(v) for v in (item.get("details") or {}).values()]))
+
+def item_metal(item):
+    text = item_text(item)
+    for metal, words in METAL_WORDS.items():
+        if any(w in text for w in words):
+            return metal
+    return None
+
+def needs_layer(conditions) -> bool:
+    return conditions is None or conditions["feels"] < LAYER_BELOW or conditions["rain"] >= 50
+
+def score_item(item, conditions, recent, today) -> float:
+    """Higher is better: rested items that suit the weather and weren't just worn.
 
+    recent is (ids, text): item ids from recent suggestions, plus the folded
+    text of older ones saved without ids.
+    """
+    last_worn = item.get("last_worn")
+    try:
+        rested = (today - datetime.fromisoformat(last_worn[:10]).date()).days if last_worn else 30
+    except ValueError:
+        rested = 30
+    score = min(rested, 30) - min(item.get("times_worn") or 0, 50) * 0.05
+    recent_ids, recent_text = recent
+    if item["id"] in recent_ids or (recent_text and fold_text(item["name"]) in recent_text):
+        score -= 20
+    if conditions:
+        text = item_text(item)
+        if conditions["feels"] <= COLD_BELOW and any(w in text for w in COOL_WORDS):
+            score -= 15
+        if conditions["feels"] >= HOT_ABOVE and any(w in text for w in WARM_WORDS):
+            score -= 15
+        if conditions["rain"] >= 50 and any(w in text for w in WET_WORDS):
+            score -= 10
+    return score
+
+def shortlist(ctx, per_category=None):
+    """Best clean candidates per category, best first. Sets ctx["metal"].
+    ctx["conditions"], when set, stands in for today's weather."""
+    per_category = per_category or OUTFIT_CANDIDATES
+    conditions = ctx.get("conditions") or weather_conditions(ctx["city"])
+    recent_ids, untagged = set(), []
+    for entry in ctx["history"]:
+        ids = [item_id for _, item_id in outfit_item_ids(entry.get("outfit_text"))]
+        recent_ids.update(ids)
+        if not ids:
+            untagged.append(entry.get("outfit_text") or "")
+    recent = (recent_ids, fold_text(" ".join(untagged)))
+    today = ctx["now"].date()
+    ranked = {}
+    for item in ctx["available"]:
+        ranked.setdefault(item["category"], []).append((score_item(item, conditions, recent, today), item))
+    for pairs in ranked.values():
+        pairs.sort(key=lambda p: (-p[0], p[1]["id"]))
+    # The best-ranked metallic piece picks the metal for everything else
+    metallic = [p for cat in METAL_CATEGORIES for p in ranked.get(cat, []) if item_metal(p[1])]
+    metal = item_metal(max(metallic, key=lambda p: (p[0], -p[1]["id"]))[1]) if metallic else None
+    if metal:
+        for cat in METAL_CATEGORIES & ranked.keys():
+            ranked[cat] = [p for p in ranked[cat] if item_metal(p[1]) in (None, metal)]
+    if not needs_layer(conditions):
+        ranked.pop("capas", None)
+    ctx["metal"] = metal
+    return {cat: [item for _, item in pairs[:per_category]] for cat, pairs in ranked.items() if pairs}
+
+def describe_item(item) -> str:
+    color = (item.get("details") or {}).get("color")
+    return item["name"] + (f" ({color})" if color and fold_text(color) not in fold_text(item["name"]) else "")
+
+def local_outfit(ctx, avoid=None, note=None) -> str:
+    """A complete outfit from ctx["candidates"] without the LLM, in the same format"""
+    candidates = ctx.get("candidates") or shortlist(ctx)
+    conditions = weather_conditions(ctx["city"])
+    avoid_ids = {item_id for _, item_id in outfit_item_ids(avoid)}
+    avoid_text = fold_text(avoid or "")
+    lines = ["🔥 Outfit rápido", ""]
+    alerts = [note] if note else []
+    for emoji, categories, count, required in OUTFIT_SLOTS:
+        if emoji == "🧢" and not (conditions and conditions["feels"] >= HOT_ABOVE):
+            continue
+        pool = [i for cat in categories for i in candidates.get(cat, [])]
+        # Prefer what the previous suggestion didn't use
+        pool.sort(key=lambda i: i["id"] in avoid_ids or fold_text(i["name"]) in avoid_text)
+        picks = pool[:count]
+        if picks:
+            lines.append(f"{emoji} " + " + ".join(f"[{i['id']}] {describe_item(i)}" for i in picks))
+        elif required:
+            dirty = any(i["category"] in categories for i in ctx["dirty"])
+            alerts.append(f"Sin {categories[0]} limpio" + (" — toca lavar" if dirty else ""))
+    lines += ["", "💡 Lo limpio que menos has usado y que va con el clima."]
+    if alerts:
+        lines.append("⚠️ " + ". ".join(alerts))
+    return "\n".join(lines)
+
+
+# --- LLM Latency Budget ---
+# One outfit request gets LLM_BUDGET seconds of Gemini, tried down LLM_MODELS
+# (fallbacks answer with fewer output tokens). An attempt still silent after
+# that model's recent p95 (time to answer, or to the first chunk when
+# streaming) gets a hedge: the same call again, and the first one to answer
+# wins. LLM_BREAKER_FAILURES failures in a row take a model out of the chain
+# for LLM_BREAKER_COOLDOWN seconds. llm_request_seconds{path=...} records
+# what served each request: cache, a model (+hedge), local or local_fallback.
+LLM_MODELS = [GEMINI_MODEL] + [m for m in LLM_FALLBACK_MODELS if m != GEMINI_MODEL]
+
+class Breaker:
+    """Consecutive-failure circuit breaker; once the cooldown is over, a single
+    trial call decides whether it closes again"""
+
+    def __init__(self, model):
+        self.model = model
+        self.failures = 0
+        self.opened_at = None
+        self.trial_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        now = monotonic()
+        if now - self.opened_at < LLM_BREAKER_COOLDOWN:
+            return False
+        if self.trial_at is not None and now - self.trial_at < LLM_TIMEOUT:
+            return False
+        self.trial_at = now
+        return True
+
+    def record(self, ok):
+        self.trial_at = None
+        if ok:
+            if self.opened_at is not None:
+                logger.info(f"{self.model} answering again, breaker closed")
+            self.failures, self.opened_at = 0, None
+            return
+        self.failures += 1
+        if self.failures >= LLM_BREAKER_FAILURES:
+            if self.opened_at is None:
+                stats["llm_breaker_open"] += 1
+                logger.warning(f"{self.model} failed {self.failures} times in a row, breaker open")
+            self.opened_at = monotonic()
+
+_breakers = {}  # model -> Breaker
+_llm_latencies = {}  # (model, streaming) -> recent seconds to answer / to first chunk
+
+def breaker(model) -> Breaker:
+    if model not in _breakers:
+        _breakers[model] = Breaker(model)
+    return _breakers[model]
+
+def hedge_delay(model, streaming) -> float:
+    """p95 of the model's recent latencies; LLM_HEDGE_DELAY until there are enough"""
+    samples = _llm_latencies.get((model, streaming))
+    if not samples or len(samples) < LLM_HEDGE_SAMPLES:
+        return LLM_HEDGE_DELAY
+    ranked = sorted(samples)
+    return max(LLM_HEDGE_MIN_DELAY, ranked[min(len(ranked) - 1, int(len(ranked) * 0.95))])
+
+async def hedged_call(request, on_text, timeout):
+    """One model, with a hedge after hedge_delay(); returns (text, whether the
+    hedge won). Streaming, the first attempt to send a chunk wins and the other
+    is cancelled, so on_text only ever sees one stream."""
+    model = request["model"]
+    streaming = on_text is not None
+    window = _llm_latencies.setdefault((model, streaming), deque(maxlen=LLM_LATENCY_WINDOW))
+    leader = None
+
+    async def call(n):
+        nonlocal leader
+        start = perf_counter()
+        if not streaming:
+            text = (await gemini.aio.models.generate_content(**request)).text
+            window.append(perf_counter() - start)
+        else:
+            text = ""
+            async for chunk in await gemini.aio.models.generate_content_stream(**request):
+                if not chunk.text:
+                    continue
+                if leader is None:
+                    leader = n
+                    window.append(perf_counter() - start)
+                    observe("stage_seconds", perf_counter() - start, stage="llm_ttft")
+                    for other in attempts:
+                        if other is not attempts[n]:
+                            other.cancel()
+                text += chunk.text
+                on_text(text)
+        if not text:
+            raise ValueError("empty response")
+        return n, text
+
+    attempts = [asyncio.ensure_future(call(0))]
+    pending = set(attempts)
+    start = monotonic()
+    hedge_at = start + hedge_delay(model, streaming)
+    error = None
+    try:
+        while pending:
+            now = monotonic()
+            if now >= start + timeout:
+                raise TimeoutError(f"{model} took over {timeout:.0f}s")
+            hedge_due = len(attempts) == 1 and leader is None and hedge_at < start + timeout
+            wake = hedge_at if hedge_due else start + timeout
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, wake - now),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception() is None:
+                    n, text = task.result()
+                    return text, n == 1
+                error = task.exception()
+            if pending and hedge_due and monotonic() >= hedge_at:
+                stats["llm_hedges"] += 1
+                attempts.append(asyncio.ensure_future(call(1)))
+                pending.add(attempts[1])
+        raise error
+    finally:
+        for task in attempts:
+            task.cancel()
+
+async def generate(request, on_text=None, fallback_max_tokens=LLM_FALLBACK_MAX_TOKENS):
+    """Run a Gemini request down LLM_MODELS within LLM_BUDGET; returns
+    (text, path). Fallback models answer in at most fallback_max_tokens.
+    Raises the last error when no model answered in time."""
+    deadline = monotonic() + LLM_BUDGET
+    error = TimeoutError("no model available")
+    for model in LLM_MODELS:
+        model_breaker = breaker(model)
+        remaining = deadline - monotonic()
+        if remaining <= 0:
+            error = TimeoutError(f"LLM budget of {LLM_BUDGET:.0f}s spent")
+            break
+        if not model_breaker.allow():
+            stats["llm_breaker_skips"] += 1
+            continue
+        attempt = {**request, "model": model}
+        if model != GEMINI_MODEL:
+            attempt["config"] = request["config"].model_copy(update={"max_output_tokens": fallback_max_tokens})
+        try:
+            with stage("llm", model=model, streaming=on_text is not None):
+                text, hedged = await hedged_call(attempt, on_text, min(LLM_TIMEOUT, remaining))
+        except Exception as e:
+            model_breaker.record(False)
+            stats["llm_errors"] += 1
+            logger.warning(f"{model} failed ({e!r})")
+            error = e
+            continue
+        model_breaker.record(True)
+        return text, f"{model}+hedge" if hedged else model
+    raise error
 
 # --- AI Outfit Engine ---
 SYSTEM_PROMPT = """Eres un stylist personal de Los Angeles. Tu clienta es una mujer queer de 36 años que prefiere vestir masculino/andrógino. Tu vibe es edgy pero accesible — piensa East LA meets Silverlake, no West Hollywood.
@@ -227,7 +2115,7 @@ TONO:
 - Ve directo al outfit, sin párrafos de introducción
 
 REGLAS:
-1. SOLO sugiere prendas DISPONIBLES (status: clean) — referencia por nombre exacto
+1. SOLO sugiere prendas DISPONIBLES (status: clean) — cada prenda con su [id] y nombre exacto
 2. Incluye: underwear, calcetines, pantalón, top, calzado. Capa solo si el clima lo requiere
 3. Sugiere reloj O smartwatch+banda según el outfit
 4. Sugiere plugs/expansores que combinen (los usa siempre)
@@ -242,32 +2130,73 @@ REGLAS:
 FORMATO (ir directo, sin intro):
 🔥 [Nombre corto del outfit]
 
-🩲 [prenda]
-🧦 [prenda]
-👖 [prenda]
-👕 [prenda]
-👟 [prenda]
-🧥 [solo si hace frío]
-🧢 [solo si aplica]
-⌚ [reloj o smartwatch+banda]
-👂 [plugs]
-💍 [joyería]
+🩲 [id] prenda
+🧦 [id] prenda
+👖 [id] prenda
+👕 [id] prenda
+👟 [id] prenda
+🧥 [id] prenda (solo si hace frío)
+🧢 [id] gorra (solo si aplica)
+⌚ [id] reloj o smartwatch + [id] banda
+👂 [id] plugs
+💍 [id] anillo + [id] anillo
 
 💡 [1 línea de por qué funciona]
 ⚠️ [alertas si hay]"""
 
-async def get_ai_suggestion(user_message: str, city_override: str = None) -> str:
-    client = genai.Client(api_key=GEMINI_API_KEY)
-    wardrobe_context = build_ai_context()
-    profile = db_get_profile()
-    city = city_override or profile.get("city", "Saltillo, Coahuila")
-    weather = get_weather(city)
-    today = datetime.now()
-    day_info = f"Hoy es {today.strftime('%A %d de %B %Y')}, hora: {today.strftime('%H:%M')}"
-
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=f"""CONTEXTO DEL GUARDARROPA:
+# SYSTEM_PROMPT describes the owner; everyone else is known only through PERFIL
+GUEST_SYSTEM_PROMPT = (
+    "Eres un stylist personal de Los Angeles. Tu vibe es edgy pero accesible — "
+    "piensa East LA meets Silverlake, no West Hollywood.\n\n"
+    "SOBRE TU CLIENTE:\n"
+    "- Lo que sabes de su identidad, cuerpo y estilo está en PERFIL; no asumas nada fuera de eso\n\n"
+    + SYSTEM_PROMPT[SYSTEM_PROMPT.index("TONO:"):].replace("(los usa siempre)", "(solo si tiene)")
+)
+
+def system_prompt_for(chat_id):
+    return SYSTEM_PROMPT if chat_id == OWNER_CHAT_ID else GUEST_SYSTEM_PROMPT
+
+async def get_ai_suggestion(chat_id, user_message: str, city_override: str = None, on_text=None,
+                            avoid: str = None, fallback=True, raise_busy=False) -> str:
+    """Ask Gemini for an outfit. With on_text, stream the answer and call
+    on_text(text_so_far) as chunks arrive.
+
+    Answers are cached per request, wardrobe, weather and day. Passing the
+    previous answer as avoid skips the cache and asks for something different;
+    the new answer then replaces the cached one. If no model in LLM_MODELS
+    answers within LLM_BUDGET, the local engine answers instead (unless
+    fallback=False, then the error propagates). When too many requests are
+    already waiting for the LLM lane that happens too, except that with
+    raise_busy the caller gets Busy to reply "busy, try again".
+    """
+    start = perf_counter()
+    ctx = await gather_context(chat_id, city_override)
+    cache_key = response_cache_key(chat_id, user_message, ctx)
+    if not avoid:
+        cached = response_cache.get(cache_key)
+        if cached:
+            observe("llm_request_seconds", perf_counter() - start, path="cache")
+            return cached
+    with stage("prompt_build"):
+        ctx["candidates"] = shortlist(ctx)
+        if LOCAL_ONLY:
+            observe("llm_request_seconds", perf_counter() - start, path="local")
+            return local_outfit(ctx, avoid)
+        wardrobe_context = build_ai_context(ctx)
+    await gemini_ready()
+    try:
+        # Rate limits first: a request they turn away never takes a lane
+        # slot or a place in its queue, and the global wait holds neither
+        await admit_llm_call(chat_id)
+        async with llm_lane.slot():
+            city = ctx["city"]
+            weather = ctx["weather"]
+            today = ctx["now"]
+            day_info = f"Hoy es {today.strftime('%A %d de %B %Y')}, hora: {today.strftime('%H:%M')}"
+
+            request = dict(
+                model=GEMINI_MODEL,
+                contents=f"""CONTEXTO DEL GUARDARROPA:
 {wardrobe_context}
 
 CLIMA ACTUAL:
@@ -276,18 +2205,208 @@ CLIMA ACTUAL:
 FECHA: {day_info}
 CIUDAD: {city}
 
-SOLICITUD: {user_message}""",
-        config=genai.types.GenerateContentConfig(
-            system_instruction=SYSTEM_PROMPT,
-            max_output_tokens=4000,
+SOLICITUD: {user_message}""" + (f"\n\nDame una opción DISTINTA a esta: {outfit_digest(avoid, limit=400)}" if avoid else ""),
+                config=import_genai().types.GenerateContentConfig(
+                    system_instruction=system_prompt_for(chat_id),
+                    max_output_tokens=4000,
+                ),
+            )
+            prompt_tokens = estimate_tokens(request["contents"]) + estimate_tokens(request["config"].system_instruction)
+            stats["prompts"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["prompt_items"] += ctx["prompt_stats"]["items"]
+            logger.info(
+                f"Prompt ~{prompt_tokens} tokens ({ctx['prompt_stats']['items']} items, "
+                f"{ctx['prompt_stats']['pruned']} pruned)"
+            )
+            llm_start = perf_counter()
+            try:
+                text, path = await generate(request, on_text)
+            except Exception as e:
+                if not fallback:
+                    raise
+                stats["llm_fallback"] += 1
+                logger.warning(f"LLM failed after {(perf_counter() - llm_start) * 1000:.0f}ms ({e!r}), answering locally")
+                observe("llm_request_seconds", perf_counter() - start, path="local_fallback")
+                return local_outfit(ctx, avoid, note="Gemini no respondió; este lo armé con tus básicos")
+            observe("llm_request_seconds", perf_counter() - start, path=path)
+            logger.info(f"LLM via {path} in {(perf_counter() - llm_start) * 1000:.0f}ms")
+            response_cache.put(cache_key, text)
+            return text
+    except Busy:
+        # The daily job's last attempt (and anything else that didn't ask to
+        # see Busy) still gets an answer
+        if raise_busy or not fallback:
+            raise
+        stats["llm_fallback"] += 1
+        observe("llm_request_seconds", perf_counter() - start, path="local_fallback")
+        return local_outfit(ctx, avoid, note="Gemini está saturado; este lo armé con tus básicos")
+
+
+# --- Request Broker ---
+# Sits in front of get_ai_suggestion. A repeat of the request a chat already
+# has in flight joins it instead of calling Gemini again; a different request
+# cancels the older one, since only the newest answer gets read. Calls that do
+# reach Gemini take a token from the chat's bucket and from the global one.
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"rate limited, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+class Superseded(Exception):
+    """A newer request from the same chat replaced this one"""
+
+class TokenBucket:
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = monotonic()
+
+    def take(self) -> float:
+        """Spend a token; returns 0, or the seconds until one is available"""
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self):
+        """Give back a token spent on a call that never happened"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+_chat_buckets = {}
+_global_bucket = TokenBucket(LLM_GLOBAL_PER_MINUTE, LLM_GLOBAL_BURST)
+_inflight = {}  # chat_id -> flight
+
+async def admit_llm_call(chat_id):
+    """Per-chat limit fails fast; the global one queues up to LLM_GLOBAL_MAX_WAIT"""
+    bucket = _chat_buckets.get(chat_id)
+    if bucket is None:
+        bucket = _chat_buckets[chat_id] = TokenBucket(LLM_CHAT_PER_MINUTE, LLM_CHAT_BURST)
+    wait = bucket.take()
+    if wait:
+        stats["llm_rate_limited"] += 1
+        raise RateLimited(wait)
+    waited = 0.0
+    while wait := _global_bucket.take():
+        if waited + wait > LLM_GLOBAL_MAX_WAIT:
+            stats["llm_rate_limited"] += 1
+            bucket.refund()
+            raise RateLimited(wait)
+        stats["llm_queued"] += 1
+        await asyncio.sleep(wait)
+        waited += wait
+
+def flight_key(request, avoid=None):
+    return " ".join(search_tokens(request)), bool(avoid)
+
+def request_in_flight(chat_id, request, avoid=None):
+    flight = _inflight.get(chat_id)
+    return bool(flight and flight["key"] == flight_key(request, avoid) and not flight["task"].done())
+
+async def broker_suggestion(chat_id, request, on_text=None, avoid=None):
+    """get_ai_suggestion with coalescing and superseding; raises Superseded or RateLimited"""
+    key = flight_key(request, avoid)
+    current = _inflight.get(chat_id)
+    if current and not current["task"].done():
+        if current["key"] == key:
+            stats["llm_coalesced"] += 1
+            try:
+                return await asyncio.shield(current["task"])
+            except asyncio.CancelledError:
+                if current["superseded"]:
+                    raise Superseded()
+                raise
+        current["superseded"] = True
+        current["task"].cancel()
+        stats["llm_superseded"] += 1
+    flight = {
+        "key": key,
+        "task": asyncio.ensure_future(
+            get_ai_suggestion(chat_id, request, on_text=on_text, avoid=avoid, raise_busy=True)
         ),
-    )
-    return response.text
+        "superseded": False,
+    }
+    _inflight[chat_id] = flight
+    try:
+        return await flight["task"]
+    except asyncio.CancelledError:
+        if flight["superseded"]:
+            raise Superseded()
+        raise
+    finally:
+        if _inflight.get(chat_id) is flight:
+            del _inflight[chat_id]
+
+
+# --- Streaming Replies ---
+def split_message(text, limit=TELEGRAM_MAX_MESSAGE):
+    """Split text into Telegram-sized chunks, breaking between lines where possible"""
+    chunks, current = [], ""
+    for line in text.split("\n"):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        candidate = f"{current}\n{line}" if current else line
+        if len(candidate) > limit:
+            chunks.append(current)
+            candidate = line
+        current = candidate
+    if current or not chunks:
+        chunks.append(current)
+    return chunks
+
+class LiveReply:
+    """Edits a placeholder message in place while a streamed answer grows.
+
+    Edits are fire-and-forget and at most one every STREAM_EDIT_INTERVAL
+    seconds, so the stream is never held up by Telegram and we stay well
+    under its per-chat edit limits.
+    """
+
+    def __init__(self, placeholder):
+        self.placeholder = placeholder
+        self.shown = placeholder.text
+        self.last_edit = 0.0
+        self.pending = None
+
+    def update(self, text):
+        if self.pending and not self.pending.done():
+            return
+        if monotonic() - self.last_edit < STREAM_EDIT_INTERVAL:
+            return
+        self.last_edit = monotonic()
+        self.pending = asyncio.ensure_future(self._edit(split_message(text)[0] + " ▍"))
+
+    async def _edit(self, text):
+        if text == self.shown:
+            return
+        try:
+            await self.placeholder.edit_text(text)
+            self.shown = text
+        except Exception as e:
+            logger.warning(f"Live edit failed: {e}")
+
+    async def finish(self, text):
+        """Show the final text, sending whatever doesn't fit as extra messages"""
+        if self.pending:
+            await self.pending
+        first, *rest = split_message(text)
+        await self._edit(first)
+        for chunk in rest:
+            await self.placeholder.reply_text(chunk)
 
 
 # --- Telegram Handlers ---
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    profile = db_get_profile()
+    chat_id = update.effective_chat.id
+    profile = await db_get_profile(chat_id)
     city = profile.get("city", "Saltillo, Coahuila")
     daily = "ON" if profile.get("daily_enabled") else "OFF"
     await update.message.reply_text(
@@ -298,16 +2417,22 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• 'voy a un bar con amigos'\n"
         "• 'me voy a CDMX 3 días, concierto de rock'\n"
         "• 'outfit para hoy'\n"
-        "O usa /outfit [ocasión]\n\n"
+        "O usa /outfit [ocasión]\n"
+        "/viaje CDMX 3 — Outfits por día + qué empacar\n"
+        "/otra — Otra opción para lo mismo\n"
+        "/usar — Me lo pongo (cuenta usos)\n\n"
         "👕 GUARDARROPA:\n"
         "/add [cat] [nombre] — Agregar prenda\n"
         "/addpro — Agregar con detalles\n"
         "/bulk — Agregar muchas de golpe\n"
         "/closet — Ver todo\n"
-        "/available — Solo lo limpio\n\n"
+        "/available — Solo lo limpio\n"
+        "/rotacion — Lo que más y menos usas\n\n"
         "🧺 STATUS:\n"
         "/dirty [id] [razón] — Marcar sucia\n"
+        "/dirty 3 5 calcetines negros — Varias de golpe\n"
         "/clean [id] — Marcar limpia\n"
+        "/clean all, /clean calzado — Todo lo sucio a limpio\n"
         "/lost [id] [dónde] — Marcar perdida\n"
         "/where [id] [ubicación] — Guardar dónde está\n\n"
         "👤 PERFIL:\n"
@@ -318,8 +2443,9 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "📋 LISTAS:\n"
         "/lists — Ver todas\n"
         "/list basicos — Ver una\n"
-        "/listadd basicos Kindle — Agregar\n"
-        "/listdel basicos 3 — Quitar #3\n"
+        "/listadd basicos Kindle, cargador — Agregar\n"
+        "/listdel basicos 3 5 — Quitar #3 y #5\n"
+        "/listmove basicos 5 1 — Mover #5 al inicio\n"
         "/listnew nombre desc — Crear\n"
         "/listremove nombre — Eliminar\n\n"
         "⚙️ CONFIG:\n"
@@ -330,18 +2456,48 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Categorías: {', '.join(ALL_CATEGORIES)}"
     )
 
-async def cmd_outfit(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    occasion = " ".join(context.args) if context.args else "día normal, ir al trabajo"
-    await update.message.reply_text("🤔 Checando clóset y clima...")
+async def reply_outfit(update: Update, context: ContextTypes.DEFAULT_TYPE, request: str, retry=False):
+    chat_id = update.effective_chat.id
+    avoid = context.user_data.get("last_outfit") if retry else None
+    if request_in_flight(chat_id, request, avoid):
+        # Double tap: the answer already on its way covers this one
+        stats["llm_coalesced"] += 1
+        return
+    placeholder = await update.message.reply_text("🤔 Checando clóset y clima...")
+    live = LiveReply(placeholder)
     try:
-        suggestion = await get_ai_suggestion(occasion)
-        db_add_history(suggestion, occasion)
-        await update.message.reply_text(suggestion)
+        # Other updates from this chat may run meanwhile; a newer request supersedes this one
+        async with chat_lock_released():
+            suggestion = await broker_suggestion(
+                chat_id, request, on_text=live.update if STREAM_RESPONSES else None, avoid=avoid
+            )
+        context.user_data["last_request"] = request
+        context.user_data["last_outfit"] = suggestion
+        await db_add_history(chat_id, suggestion, request)
+        await live.finish(suggestion)
+    except Superseded:
+        await live.finish("↪️ Voy con tu mensaje más reciente")
+    except RateLimited as e:
+        await live.finish(f"⏳ Muchas solicitudes seguidas. Intenta en {max(1, round(e.retry_after))}s")
+    except Busy:
+        await live.finish("🚦 Estoy a tope ahorita. Intenta en un minuto.")
     except Exception as e:
         logger.error(f"AI error: {e}")
-        await update.message.reply_text("❌ Error. Intenta de nuevo.")
+        await live.finish("❌ Error. Intenta de nuevo.")
+
+async def cmd_outfit(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    occasion = " ".join(context.args) if context.args else "día normal, ir al trabajo"
+    await reply_outfit(update, context, occasion)
+
+async def cmd_otra(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    last = context.user_data.get("last_request")
+    if not last:
+        await update.message.reply_text("Primero pídeme un outfit 😉")
+        return
+    await reply_outfit(update, context, last, retry=True)
 
 async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if len(context.args) < 2:
         await update.message.reply_text(
             f"Uso: /add [categoría] [nombre]\n\n"
@@ -355,7 +2511,7 @@ async def cmd_add(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if category not in ALL_CATEGORIES:
         await update.message.reply_text(f"❌ '{category}' no existe.\nVálidas: {', '.join(ALL_CATEGORIES)}")
         return
-    item = db_add_item(category, name)
+    item = await db_add_item(chat_id, category, name)
     if item:
         await update.message.reply_text(f"✅ {name} → {category} (ID: {item['id']})")
     else:
@@ -381,115 +2537,284 @@ async def cmd_bulk(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     context.user_data["awaiting_bulk"] = True
 
+STATUS_SOURCES = {"clean": ("dirty",), "dirty": ("clean",), "lost": ("clean", "dirty")}
+ALL_WORDS = {"all", "todo", "toda", "todos", "todas"}
+STATUS_LIST_LIMIT = 10
+LAUNDRY_PATTERN = re.compile(r"^(ya )?(lave|lave todo|laundry done|termine (de lavar|la ropa)|ropa lavada|ya quedo la ropa)$")
+
+def is_laundry_done(text):
+    """'laundry done', 'ya lavé', ... — everything dirty is clean again"""
+    return bool(LAUNDRY_PATTERN.match(" ".join(re.findall(r"[a-z0-9]+", fold_text(text)))))
+
+def status_group(words):
+    """'all' or category names -> the categories they cover (None = every one); [] if not a group"""
+    words = [fold_text(w) for w in words]
+    if words and all(w in ALL_WORDS for w in words):
+        return None
+    if words and all(w in ALL_CATEGORIES for w in words):
+        return words
+    return []
+
 async def cmd_status_change(update: Update, context: ContextTypes.DEFAULT_TYPE):
     command = update.message.text.split()[0].replace("/", "")
     status_map = {"dirty": "dirty", "clean": "clean", "lost": "lost"}
     new_status = status_map.get(command, "clean")
     if not context.args:
-        await update.message.reply_text(f"Uso: /{command} [id o nombre] [razón opcional]")
+        await update.message.reply_text(
+            f"Uso: /{command} [id o nombre] [razón opcional]\n"
+            f"Varias: /{command} 3 5 calcetines negros | razón\n"
+            f"Por grupo: /{command} all, /{command} calzado"
+        )
         return
-    search = context.args[0]
-    reason = " ".join(context.args[1:]) if len(context.args) > 1 else ""
-    item = db_find_item(search)
-    if item:
-        updates = {"status": new_status}
-        if reason:
-            updates["details"] = {**(item.get("details") or {}), "status_reason": reason}
-        db_update_item(item["id"], **updates)
-        emoji = {"clean": "✅", "dirty": "🧺", "lost": "❓"}.get(new_status, "📌")
-        msg = f"{emoji} {item['name']} → {new_status}"
-        if reason:
-            msg += f" ({reason})"
-        await update.message.reply_text(msg)
+    await change_status(update, new_status, " ".join(context.args))
+
+async def change_status(update: Update, new_status, text):
+    """Resolve the items in text (ids, names, 'all' or categories) and move
+    them all to new_status in one update"""
+    chat_id = update.effective_chat.id
+    targets, _, reason = text.partition("|")
+    reason = reason.strip()
+    words = targets.split()
+    group = status_group(words)
+    found = []
+    if group != []:
+        # Only items in the status this one usually follows: /clean all cleans what's dirty
+        items = [
+            item for item in await db_get_items(chat_id, status=STATUS_SOURCES[new_status])
+            if group is None or item["category"] in group
+        ]
     else:
-        await update.message.reply_text(f"❌ No encontré '{search}'. Usa /closet para ver IDs.")
+        if "|" in text or "," in targets or sum(w.lstrip("#").isdigit() for w in words) > 1:
+            found = await db_find_many(chat_id, targets)
+        else:
+            # Single item: everything after its id/name is the reason
+            item, rest = await db_find_leading(chat_id, words)
+            reason = " ".join(rest) if item else ""
+            found = [(targets.strip() if not item else words[0], item)]
+        items = list({item["id"]: item for _, item in found if item}.values())
+    missing = [ref for ref, item in found if not item]
+    emoji = {"clean": "✅", "dirty": "🧺", "lost": "❓"}.get(new_status, "📌")
+    count = await db_set_status(chat_id, [item["id"] for item in items], new_status, reason)
+    suffix = f" ({reason})" if reason else ""
+    lines = []
+    if len(items) == 1:
+        lines.append(f"{emoji} {items[0]['name']} → {new_status}{suffix}")
+    elif items:
+        lines.append(f"{emoji} {count} prendas → {new_status}{suffix}")
+        lines += [f"  • [{item['id']}] {item['name']}" for item in items[:STATUS_LIST_LIMIT]]
+        if len(items) > STATUS_LIST_LIMIT:
+            lines.append(f"  … y {len(items) - STATUS_LIST_LIMIT} más")
+    elif group != []:
+        scope = ", ".join(group) if group else "tu clóset"
+        lines.append(f"👌 Nada que cambiar: no hay prendas {'/'.join(STATUS_SOURCES[new_status])} en {scope}")
+    for ref in missing:
+        msg = f"❌ No encontré '{ref}'."
+        suggestions = await db_find_items(chat_id, ref, limit=3)
+        if suggestions:
+            msg += " ¿Quisiste decir " + ", ".join(f"[{i['id']}] {i['name']}" for i in suggestions) + "?"
+        else:
+            msg += " Usa /closet para ver IDs."
+        lines.append(msg)
+    await update.message.reply_text("\n".join(lines) or "❌ No encontré nada. Usa /closet para ver IDs.")
 
 async def cmd_where(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if len(context.args) < 2:
         await update.message.reply_text("Uso: /where [id o nombre] [ubicación]\nEj: /where 5 clóset negro, colgado")
         return
-    search = context.args[0]
-    location = " ".join(context.args[1:])
-    item = db_find_item(search)
+    item, rest = await db_find_leading(chat_id, context.args)
+    if not rest:
+        # The whole text matched an item name; treat the last word as the location
+        item, rest = await db_find_leading(chat_id, context.args[:-1])
+        rest = rest + context.args[-1:]
+    location = " ".join(rest)
     if item:
-        db_update_item(item["id"], location=location)
+        await db_update_item(chat_id, item["id"], location=location)
         await update.message.reply_text(f"📍 {item['name']} → {location}")
     else:
-        await update.message.reply_text(f"❌ No encontré '{search}'.")
+        await update.message.reply_text(f"❌ No encontré '{context.args[0]}'.")
+
+def closet_line(item) -> str:
+    emoji = {"clean": "✅", "dirty": "🧺", "lost": "❓", "damaged": "⚠️"}.get(item["status"], "❔")
+    details = item.get("details") or {}
+    detail_str = ""
+    if details:
+        parts = [f"{k}: {v}" for k, v in details.items() if k != "status_reason"]
+        if parts:
+            detail_str = " | " + ", ".join(parts)
+    loc_str = f" 📍{item['location']}" if item.get("location") else ""
+    return f"  {emoji} [{item['id']}] {item['name']}{detail_str}{loc_str}"
+
+def available_line(item) -> str:
+    return f"  • [{item['id']}] {item['name']}"
+
+# view -> (title, status filter, line renderer, empty-closet text)
+CLOSET_VIEWS = {
+    "all": ("👔 TU GUARDARROPA", None, closet_line, "👔 Guardarropa vacío. Usa /add o /bulk para agregar prendas."),
+    "clean": ("✅ DISPONIBLE", "clean", available_line, "😬 No tienes nada limpio. ¡A lavar!"),
+}
+
+def render_page(items, line, limit, from_end=False):
+    """Items under category headings, never cut mid-line: whole items are
+    dropped from the end (the start, with from_end) until it fits.
+    Returns (text, items shown)."""
+    def render(run):
+        lines, category = [], None
+        for item in run:
+            if item["category"] != category:
+                category = item["category"]
+                lines.append(f"\n📦 {category.upper()}")
+            lines.append(line(item))
+        return "\n".join(lines)
+
+    shown = list(items)
+    text = render(shown)
+    while len(text) > limit and len(shown) > 1:
+        shown = shown[1:] if from_end else shown[:-1]
+        text = render(shown)
+    if len(text) > limit:
+        text = text[:limit - 1] + "…"
+    return text, shown
+
+def closet_button(label, view, direction, category, item_id):
+    return InlineKeyboardButton(label, callback_data=f"closet:{view}:{direction}:{category}:{item_id}")
+
+async def closet_page(chat_id, view, after=None, before=None):
+    """Text and inline keyboard for one page of a closet view"""
+    title, status, line, empty = CLOSET_VIEWS[view]
+    store = await get_wardrobe(chat_id)
+    items, start, total = store.page(status, after=after, before=before, limit=CLOSET_PAGE_SIZE)
+    if not items and total:
+        # An old button past the end of a view that has shrunk since
+        items, start, total = store.page(status, limit=CLOSET_PAGE_SIZE)
+    if not items:
+        return empty, None
+    body, shown = render_page(items, line, TELEGRAM_MAX_MESSAGE - 100, from_end=before is not None)
+    if before is not None:
+        start += len(items) - len(shown)
+    text = f"{title} ({start + 1}–{start + len(shown)} de {total}):\n{body}"
+    rows = []
+    navigation = []
+    if start > 0:
+        navigation.append(closet_button("◀️", view, "p", shown[0]["category"], shown[0]["id"]))
+    if start + len(shown) < total:
+        navigation.append(closet_button("▶️", view, "n", shown[-1]["category"], shown[-1]["id"]))
+    if navigation:
+        rows.append(navigation)
+        jumps = [closet_button(c, view, "n", c, 0) for c in store.categories(status)]
+        rows += [jumps[i:i + 3] for i in range(0, len(jumps), 3)]
+    return text, InlineKeyboardMarkup(rows) if rows else None
 
 async def cmd_closet(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    items = db_get_items()
-    if not items:
-        await update.message.reply_text("👔 Guardarropa vacío. Usa /add o /bulk para agregar prendas.")
+    text, keyboard = await closet_page(update.effective_chat.id, "all")
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+async def cmd_available(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    text, keyboard = await closet_page(update.effective_chat.id, "clean")
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+async def on_closet_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """◀️ / ▶️ / category taps under a /closet or /available page"""
+    query = update.callback_query
+    await query.answer()
+    try:
+        _, view, direction, rest = query.data.split(":", 3)
+        category, _, item_id = rest.rpartition(":")
+        key = (category, int(item_id))
+    except ValueError:
         return
-    lines = ["👔 TU GUARDARROPA:\n"]
-    current_cat = ""
-    for item in items:
-        if item["category"] != current_cat:
-            current_cat = item["category"]
-            lines.append(f"\n📦 {current_cat.upper()}")
-        emoji = {"clean": "✅", "dirty": "🧺", "lost": "❓", "damaged": "⚠️"}.get(item["status"], "❔")
-        details = item.get("details") or {}
-        detail_str = ""
-        if details:
-            parts = [f"{k}: {v}" for k, v in details.items() if k != "status_reason"]
-            if parts:
-                detail_str = " | " + ", ".join(parts)
-        loc_str = f" 📍{item['location']}" if item.get("location") else ""
-        lines.append(f"  {emoji} [{item['id']}] {item['name']}{detail_str}{loc_str}")
-    text = "\n".join(lines)
-    if len(text) > 4000:
-        for i in range(0, len(text), 4000):
-            await update.message.reply_text(text[i:i+4000])
+    if view not in CLOSET_VIEWS:
+        return
+    if direction == "p":
+        text, keyboard = await closet_page(update.effective_chat.id, view, before=key)
     else:
-        await update.message.reply_text(text)
+        text, keyboard = await closet_page(update.effective_chat.id, view, after=key)
+    try:
+        await query.edit_message_text(text, reply_markup=keyboard)
+    except BadRequest as e:
+        # A double tap asks for the page already shown; Telegram rejects the no-op edit
+        if "not modified" not in str(e).lower():
+            raise
+
+async def cmd_usar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    # The full default read: the mirror keeps whatever the last read returned
+    history = await db_get_history(chat_id)
+    entry = history[0] if history else None
+    if not entry or not entry.get("idempotency_key") or not outfit_item_ids(entry.get("outfit_text")):
+        await update.message.reply_text("Primero pídeme un outfit 😉")
+        return
+    day = datetime.now(profile_timezone(await db_get_profile(chat_id))).date()
+    items = await db_wear_outfit(chat_id, entry, day)
+    if items is None:
+        await update.message.reply_text("👌 Ese ya lo tenía anotado")
+        return
+    await update.message.reply_text(
+        f"👟 Anotado: {len(items)} prendas usadas hoy\n"
+        "/rotacion — Lo que más y menos usas"
+    )
 
-async def cmd_available(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    items = db_get_items(status="clean")
-    if not items:
-        await update.message.reply_text("😬 No tienes nada limpio. ¡A lavar!")
+async def cmd_rotacion(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    rotation = (await get_wardrobe(chat_id)).rotation()
+    if not rotation["by_category"]:
+        await update.message.reply_text("🤷 Tu clóset está vacío. Usa /add o /bulk")
         return
-    lines = ["✅ DISPONIBLE:\n"]
-    current_cat = ""
-    for item in items:
-        if item["category"] != current_cat:
-            current_cat = item["category"]
-            lines.append(f"📦 {current_cat.upper()}")
-        lines.append(f"  • [{item['id']}] {item['name']}")
+    lines = ["🔄 ROTACIÓN\n"]
+    for cat, counts in sorted(rotation["by_category"].items(), key=lambda c: c[1]["worn"] / c[1]["items"]):
+        lines.append(
+            f"📦 {cat.upper()}: {counts['worn'] / counts['items']:.1f} usos/prenda"
+            + (f", {counts['never']} sin estrenar" if counts["never"] else "")
+        )
+    if rotation["least_worn"]:
+        lines.append("\n💤 MENOS USADO (limpio):")
+        for item in rotation["least_worn"]:
+            worn = f"{item.get('times_worn') or 0} usos" + (f", último {item['last_worn'][:10]}" if item.get("last_worn") else "")
+            lines.append(f"  • [{item['id']}] {item['name']} — {worn}")
     await update.message.reply_text("\n".join(lines))
 
 async def cmd_feedback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if not context.args:
         await update.message.reply_text("Uso: /feedback me gustó el outfit de hoy")
         return
-    db_add_feedback(" ".join(context.args))
+    await db_add_feedback(chat_id, " ".join(context.args))
     await update.message.reply_text("📝 Feedback guardado 💪")
 
 async def cmd_daily(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if not context.args or context.args[0].lower() not in ("on", "off"):
         await update.message.reply_text("Uso: /daily on o /daily off")
         return
     on = context.args[0].lower() == "on"
-    db_update_profile(daily_enabled=on)
+    await db_update_profile(chat_id, daily_enabled=on)
     if on:
-        await update.message.reply_text(f"⏰ Outfit diario ON → {DAILY_HOUR}:{DAILY_MINUTE:02d}")
+        profile = await db_get_profile(chat_id)
+        zone = profile.get("timezone") or f"UTC{TIMEZONE_OFFSET:+d}"
+        await update.message.reply_text(
+            f"⏰ Outfit diario ON → {DAILY_HOUR}:{DAILY_MINUTE:02d} ({zone})\n"
+            "Cambiar zona: /profile zona America/Monterrey"
+        )
     else:
+        cancel_daily_runs(chat_id)
         await update.message.reply_text("⏰ Outfit diario OFF")
 
 async def cmd_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if not context.args:
-        profile = db_get_profile()
+        profile = await db_get_profile(chat_id)
         city = profile.get("city", "Saltillo, Coahuila")
-        weather = get_weather(city)
+        weather = await get_weather(city)
         await update.message.reply_text(f"📍 Ciudad: {city}\n🌤️ {weather}\n\nCambiar: /city Monterrey")
         return
     new_city = " ".join(context.args)
-    db_update_profile(city=new_city)
-    weather = get_weather(new_city)
+    await db_update_profile(chat_id, city=new_city)
+    weather = await get_weather(new_city)
     await update.message.reply_text(f"📍 Ciudad → {new_city}\n🌤️ {weather}")
 
 async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    profile = db_get_profile()
+    chat_id = update.effective_chat.id
+    profile = await db_get_profile(chat_id)
     if not context.args:
         lines = [
             "👤 TU PERFIL:\n",
@@ -501,8 +2826,9 @@ async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"🎨 Tono: {profile.get('skin_tone', '?')}",
             f"✨ Subtono: {profile.get('undertone', '?')}",
             f"💇 Cabello: {profile.get('hair', '?')}",
+            f"🕐 Zona: {profile.get('timezone') or f'UTC{TIMEZONE_OFFSET:+d}'}",
             "\n/profile [campo] [valor]",
-            "Campos: peso, meta, edad, pelo, tono, subtono, estatura",
+            "Campos: peso, meta, edad, pelo, tono, subtono, estatura, zona",
         ]
         await update.message.reply_text("\n".join(lines))
         return
@@ -519,21 +2845,25 @@ async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "tono": ("skin_tone", str), "skin": ("skin_tone", str),
         "subtono": ("undertone", str), "undertone": ("undertone", str),
         "estatura": ("height_cm", float), "height": ("height_cm", float),
+        "zona": ("timezone", timezone_name), "timezone": ("timezone", timezone_name),
     }
     if field in field_map:
         key, cast = field_map[field]
         try:
             parsed = cast(value) if cast != str else value
-            db_update_profile(**{key: parsed})
+            await db_update_profile(chat_id, **{key: parsed})
+            if key == "timezone":
+                cancel_daily_runs(chat_id)
             await update.message.reply_text(f"✅ {key} → {parsed}")
         except ValueError:
             await update.message.reply_text("❌ Valor inválido")
     else:
-        await update.message.reply_text("❌ Campos: peso, meta, edad, pelo, tono, subtono, estatura")
+        await update.message.reply_text("❌ Campos: peso, meta, edad, pelo, tono, subtono, estatura, zona")
 
 # --- Packing Lists ---
 async def cmd_lists(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    lists = db_get_lists()
+    chat_id = update.effective_chat.id
+    lists = await db_get_lists(chat_id)
     if not lists:
         await update.message.reply_text("📋 No hay listas. Crea con /listnew [nombre] [desc]")
         return
@@ -546,11 +2876,12 @@ async def cmd_lists(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("\n".join(lines))
 
 async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if not context.args:
         await update.message.reply_text("Uso: /list [nombre]\nEj: /list viaje")
         return
     name = context.args[0].lower()
-    lst = db_get_list(name)
+    lst = await db_get_list(chat_id, name)
     if not lst:
         await update.message.reply_text(f"❌ Lista '{name}' no existe. Ver disponibles: /lists")
         return
@@ -560,152 +2891,663 @@ async def cmd_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lines.append(f"  {i+1}. {item}")
     if not items:
         lines.append("  (vacía)")
-    lines.append(f"\n/listadd {name} [item] | /listdel {name} [#]")
+    lines.append(f"\n/listadd {name} [item], ... | /listdel {name} [#] ... | /listmove {name} [#] [#]")
     await update.message.reply_text("\n".join(lines))
 
+LIST_ITEM_SEPARATORS = re.compile(r"[,;\n]")
+
+def parse_positions(args):
+    """'2 5', '2,5', '3-6' -> [2, 5] / [3, 4, 5, 6]; ValueError on anything else"""
+    positions = []
+    for part in filter(None, re.split(r"[\s,]+", " ".join(args).replace("#", ""))):
+        first, _, last = part.partition("-")
+        first, last = int(first), int(last or first)
+        if last - first > 500:
+            raise ValueError(f"rango demasiado grande: {part}")
+        positions.extend(range(first, last + 1))
+    return positions
+
 async def cmd_listadd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if len(context.args) < 2:
-        await update.message.reply_text("Uso: /listadd [lista] [item]")
+        await update.message.reply_text("Uso: /listadd [lista] [item], [item], ...")
         return
     name = context.args[0].lower()
-    item_text = " ".join(context.args[1:])
-    lst = db_get_list(name)
-    if not lst:
+    # Raw text so items can also go one per line
+    rest = update.message.text.split(None, 2)[2]
+    new_items = [i.strip() for i in LIST_ITEM_SEPARATORS.split(rest) if i.strip()]
+    items = await db_add_list_items(chat_id, name, new_items)
+    if items is None:
         await update.message.reply_text(f"❌ '{name}' no existe. Crear: /listnew {name}")
-        return
-    items = lst.get("items") or []
-    items.append(item_text)
-    db_update_list_items(name, items)
-    await update.message.reply_text(f"✅ '{item_text}' → {name}")
+    elif len(new_items) == 1:
+        await update.message.reply_text(f"✅ '{new_items[0]}' → {name}")
+    else:
+        await update.message.reply_text(f"✅ {len(new_items)} items → {name} ({len(items)} en total)")
 
 async def cmd_listdel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if len(context.args) < 2:
-        await update.message.reply_text("Uso: /listdel [lista] [#num]")
+        await update.message.reply_text("Uso: /listdel [lista] [#num] ...\nEj: /listdel viaje 2 5 o /listdel viaje 3-6")
         return
     name = context.args[0].lower()
     try:
-        index = int(context.args[1].replace("#", "")) - 1
+        positions = parse_positions(context.args[1:])
     except ValueError:
-        await update.message.reply_text("❌ Necesito un número")
+        await update.message.reply_text("❌ Necesito números. Ej: /listdel viaje 2 5")
         return
-    lst = db_get_list(name)
-    if not lst:
+    result = await db_remove_list_items(chat_id, name, positions)
+    if result is None:
         await update.message.reply_text(f"❌ Lista '{name}' no existe")
-        return
-    items = lst.get("items") or []
-    if 0 <= index < len(items):
-        removed = items.pop(index)
-        db_update_list_items(name, items)
-        await update.message.reply_text(f"🗑️ '{removed}' eliminado de {name}")
+    elif not result["removed"]:
+        await update.message.reply_text("❌ Número fuera de rango. Usa /list [nombre]")
+    elif len(result["removed"]) == 1:
+        await update.message.reply_text(f"🗑️ '{result['removed'][0]}' eliminado de {name}")
     else:
+        await update.message.reply_text(
+            f"🗑️ {len(result['removed'])} eliminados de {name}: " + ", ".join(result["removed"])
+        )
+
+async def cmd_listmove(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    if len(context.args) != 3:
+        await update.message.reply_text("Uso: /listmove [lista] [#desde] [#hasta]\nEj: /listmove viaje 5 1")
+        return
+    name = context.args[0].lower()
+    try:
+        src, dst = (int(a.replace("#", "")) for a in context.args[1:])
+    except ValueError:
+        await update.message.reply_text("❌ Necesito dos números")
+        return
+    result = await db_move_list_item(chat_id, name, src, dst)
+    if result is None:
+        await update.message.reply_text(f"❌ Lista '{name}' no existe")
+    elif result["moved"] is None:
         await update.message.reply_text("❌ Número fuera de rango. Usa /list [nombre]")
+    else:
+        position = min(max(dst, 1), len(result["items"]))
+        await update.message.reply_text(f"↕️ '{result['moved']}' → #{position} en {name}")
 
 async def cmd_listnew(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if not context.args:
         await update.message.reply_text("Uso: /listnew [nombre] [descripción]")
         return
     name = context.args[0].lower()
     desc = " ".join(context.args[1:]) if len(context.args) > 1 else ""
-    result = db_create_list(name, desc)
+    result = await db_create_list(chat_id, name, desc)
     if result:
         await update.message.reply_text(f"✅ Lista '{name}' creada")
     else:
         await update.message.reply_text(f"⚠️ '{name}' ya existe")
 
 async def cmd_listremove(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     if not context.args:
         await update.message.reply_text("Uso: /listremove [nombre]\n⚠️ Elimina la lista completa")
         return
     name = context.args[0].lower()
-    if db_delete_list(name):
+    if await db_delete_list(chat_id, name):
         await update.message.reply_text(f"🗑️ Lista '{name}' eliminada")
     else:
         await update.message.reply_text(f"❌ '{name}' no existe")
 
+# --- Trip Planner ---
+# "me voy a CDMX 3 días" plans the whole trip in one Gemini call. The
+# forecast comes from the same wttr.in payload as the destination's current
+# weather, the model answers JSON (each day's outfit as item ids) and the
+# packing list is every item used, once, plus extras. 💾 saves it through
+# the packing list functions. Without Gemini, local_trip() plans from the
+# shortlist instead.
+TRIP_PATTERNS = [
+    re.compile(r"\b(?:me voy|voy|viajo|salgo)\s+(?:a|para)\s+(?P<city>[^\d,.;!?]+?)\s*,?\s*(?:por\s+)?"
+               r"(?P<days>\d{1,2})\s*d[ií]as?\b(?P<rest>.*)", re.I | re.S),
+    re.compile(r"\b(?:me voy|voy|viajo|salgo)\s+(?:por\s+)?(?P<days>\d{1,2})\s*d[ií]as?\s+(?:a|para)\s+"
+               r"(?P<city>[^\d,.;!?]+)(?P<rest>.*)", re.I | re.S),
+]
+# A "city" ending in one of these is the start of a phrase ("una boda en"),
+# and one naming an event or a place in town is an outing, not a trip
+TRIP_CITY_TAILS = {"a", "al", "en", "por", "de", "del", "para", "con"}
+TRIP_NOT_PLACES = {
+    "boda", "fiesta", "cena", "cenar", "comer", "comida", "desayuno", "oficina", "trabajo", "trabajar",
+    "escuela", "clase", "clases", "bar", "antro", "concierto", "gym", "gimnasio", "junta", "reunion",
+    "cita", "entrevista", "cumpleanos", "casa", "evento", "graduacion", "partido", "semana",
+}
+DAILY_FRESH = {"underwear", "socks", "tops"}  # a new one each day; everything else repeats
+TRIP_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "days": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "title": {"type": "STRING"},
+                    "items": {"type": "ARRAY", "items": {"type": "INTEGER"}},
+                    "why": {"type": "STRING"},
+                },
+                "required": ["title", "items"],
+            },
+        },
+        "extras": {"type": "ARRAY", "items": {"type": "STRING"}},
+        "alerts": {"type": "STRING"},
+    },
+    "required": ["days"],
+}
+
+def parse_trip(text):
+    """'me voy a CDMX 3 días, concierto' -> ('CDMX', 3, 'concierto'), or None
+
+    >>> parse_trip("voy a una boda en 2 días, qué me pongo")
+    >>> parse_trip("salgo a cenar en 2 dias")
+    >>> parse_trip("voy a la oficina 2 días por semana")
+    """
+    for pattern in TRIP_PATTERNS:
+        match = pattern.search(text)
+        if not match or int(match["days"]) < 1:
+            continue
+        words = fold_text(match["city"]).split()
+        if not words or words[-1] in TRIP_CITY_TAILS or TRIP_NOT_PLACES & set(words):
+            continue
+        return match["city"].strip(), int(match["days"]), match["rest"].strip(" ,.;:-")
+    return None
+
+def trip_conditions(forecast):
+    """What the trip's candidates must cover: its coldest day, its rainiest"""
+    if not forecast:
+        return None
+    return {"feels": min((d["min"] + d["max"]) // 2 for d in forecast), "rain": max(d["rain"] for d in forecast)}
+
+def forecast_line(day) -> str:
+    return f"{day['min']}–{day['max']}°C, lluvia {day['rain']}%" + (f", {day['desc']}" if day["desc"] else "")
+
+def slot_emoji(category) -> str:
+    return next((emoji for emoji, categories, *_ in OUTFIT_SLOTS if category in categories), "✨")
+
+def parse_trip_plan(text, items, days):
+    """The model's JSON as {"days": [{"title", "items", "why"}], "extras", "alerts"},
+    keeping only ids of clean items; ValueError if nothing usable is left"""
+    data = json.loads(text)
+    if not isinstance(data, dict) or not isinstance(data.get("days"), list):
+        raise ValueError("trip plan without days")
+    plan_days = []
+    for day in data["days"][:days]:
+        if not isinstance(day, dict):
+            continue
+        ids = [i for i in dict.fromkeys(day.get("items") or []) if isinstance(i, int) and i in items]
+        if ids:
+            plan_days.append({"title": str(day.get("title") or "").strip(), "items": ids,
+                              "why": str(day.get("why") or "").strip()})
+    if not plan_days:
+        raise ValueError("trip plan uses no clean items")
+    extras = [str(e).strip() for e in data.get("extras") or [] if str(e).strip()]
+    return {"days": plan_days, "extras": extras, "alerts": str(data.get("alerts") or "").strip()}
+
+def local_trip(ctx, days, note=None):
+    """A trip plan from ctx["candidates"] without the LLM: fresh underwear,
+    socks and top every day, the same everything else"""
+    candidates = ctx["candidates"]
+    conditions = ctx.get("conditions")
+    plan_days = []
+    for n in range(days):
+        ids = []
+        for emoji, categories, count, required in OUTFIT_SLOTS:
+            if emoji == "🧢" and not (conditions and conditions["feels"] >= HOT_ABOVE):
+                continue
+            pool = [i for cat in categories for i in candidates.get(cat, [])]
+            first = n * count if DAILY_FRESH & set(categories) else 0
+            ids += [pool[(first + k) % len(pool)]["id"] for k in range(min(count, len(pool)))]
+        plan_days.append({"title": "Outfit rápido", "items": list(dict.fromkeys(ids)), "why": ""})
+    return {"days": plan_days, "extras": [], "alerts": note or ""}
+
+def trip_packing(plan, items):
+    """Every item the plan uses, once, in closet order, then the extras"""
+    used = {item_id for day in plan["days"] for item_id in day["items"]}
+    order = {cat: n for n, cat in enumerate(ALL_CATEGORIES)}
+    packed = sorted((items[i] for i in used), key=lambda i: (order.get(i["category"], len(order)), i["id"]))
+    entries = [f"[{i['id']}] {describe_item(i)}" for i in packed]
+    seen = set()
+    for extra in plan["extras"]:
+        if fold_text(extra) not in seen:
+            seen.add(fold_text(extra))
+            entries.append(extra)
+    return entries
+
+def render_trip(city, forecast, plan, items, packing) -> str:
+    lines = [f"🧳 {city.upper()} — {len(plan['days'])} días", ""]
+    packed_before = set()
+    for n, day in enumerate(plan["days"]):
+        weather = forecast_line(forecast[n]) if n < len(forecast) else "sin pronóstico"
+        lines.append(f"📅 DÍA {n + 1} · {weather}")
+        if day["title"]:
+            lines.append(f"🔥 {day['title']}")
+        for item_id in day["items"]:
+            item = items[item_id]
+            repeat = " ♻️" if item_id in packed_before else ""
+            lines.append(f"{slot_emoji(item['category'])} [{item_id}] {describe_item(item)}{repeat}")
+        packed_before.update(day["items"])
+        if day["why"]:
+            lines.append(f"💡 {day['why']}")
+        lines.append("")
+    lines.append(f"🎒 EMPACAR ({len(packing)}):")
+    lines += [f"  • {entry}" for entry in packing]
+    if plan["alerts"]:
+        lines += ["", f"⚠️ {plan['alerts']}"]
+    return "\n".join(lines)
+
+async def get_trip_plan(chat_id, city, days, occasion=""):
+    """(plan, forecast, clean items by id) for a trip, every day from one
+    Gemini call; plan is None when nothing is clean. Raises Busy/RateLimited
+    like get_ai_suggestion."""
+    start = perf_counter()
+    ctx = await gather_context(chat_id, city)
+    items = {i["id"]: i for i in ctx["available"]}
+    if not items:
+        return None, [], items
+    forecast = forecast_days(city, days)
+    ctx["conditions"] = trip_conditions(forecast)
+    with stage("prompt_build"):
+        ctx["candidates"] = shortlist(ctx, per_category=OUTFIT_CANDIDATES + days)
+        wardrobe_context = build_ai_context(ctx)
+    if LOCAL_ONLY:
+        observe("trip_request_seconds", perf_counter() - start, path="local")
+        return local_trip(ctx, days), forecast, items
+
+    outlook = [f"Día {n + 1} ({d['date']}): {forecast_line(d)}" for n, d in enumerate(forecast)]
+    if len(forecast) < days:
+        outlook.append(f"Día {len(forecast) + 1} en adelante: sin pronóstico" + (
+            f", asume algo como el día {len(forecast)}" if forecast else f". Hoy: {ctx['weather']}"))
+    # Cut-off JSON is no plan at all, so fallback models get the same room
+    max_tokens = 500 + TRIP_TOKENS_PER_DAY * days
+    await gemini_ready()
+    try:
+        await admit_llm_call(chat_id)
+        async with llm_lane.slot():
+            request = dict(
+                model=GEMINI_MODEL,
+                contents=f"""CONTEXTO DEL GUARDARROPA:
+{wardrobe_context}
+
+PRONÓSTICO EN {city}:
+{chr(10).join(outlook)}
+
+VIAJE: {days} días en {city}, desde el {ctx['now'].strftime('%d/%m/%Y')}
+SOLICITUD: {occasion or 'viaje'}
+
+Arma un outfit completo por día con las mismas REGLAS, para una sola maleta: repite calzado, pantalones, capas y accesorios lo más posible (regla VIAJES); underwear, calcetines y top cambian cada día. Ignora el FORMATO de texto y responde solo el JSON: en items van los ids de las prendas; en extras, lo que no es ropa del clóset y hace falta llevar.""",
+                config=import_genai().types.GenerateContentConfig(
+                    system_instruction=system_prompt_for(chat_id),
+                    max_output_tokens=max_tokens,
+                    response_mime_type="application/json",
+                    response_schema=TRIP_SCHEMA,
+                ),
+            )
+            text, path = await generate(request, fallback_max_tokens=max_tokens)
+        plan = parse_trip_plan(text, items, days)
+    except (Busy, RateLimited):
+        raise
+    except Exception as e:
+        stats["llm_fallback"] += 1
+        logger.warning(f"Trip plan failed ({e!r}), planning locally")
+        plan, path = local_trip(ctx, days, note="Gemini no respondió; este lo armé con tus básicos"), "local_fallback"
+    observe("trip_request_seconds", perf_counter() - start, path=path)
+    return plan, forecast, items
+
+def trip_list_name(city) -> str:
+    return "viaje-" + re.sub(r"[^a-z0-9]+", "-", fold_text(city)).strip("-")
+
+async def plan_trip(update: Update, context: ContextTypes.DEFAULT_TYPE, city, days, occasion=""):
+    chat_id = update.effective_chat.id
+    note = ""
+    if days > TRIP_MAX_DAYS:
+        note, days = f"\n\n(Planeé los primeros {TRIP_MAX_DAYS} días; repite desde el día 1)", TRIP_MAX_DAYS
+    placeholder = await update.message.reply_text(f"🧳 Armando {days} días en {city}...")
+    try:
+        async with chat_lock_released():
+            plan, forecast, items = await get_trip_plan(chat_id, city, days, occasion)
+    except RateLimited as e:
+        await placeholder.edit_text(f"⏳ Muchas solicitudes seguidas. Intenta en {max(1, round(e.retry_after))}s")
+        return
+    except Busy:
+        await placeholder.edit_text("🚦 Estoy a tope ahorita. Intenta en un minuto.")
+        return
+    except Exception as e:
+        logger.error(f"Trip error: {e}")
+        await placeholder.edit_text("❌ Error. Intenta de nuevo.")
+        return
+    if plan is None:
+        await placeholder.edit_text("😬 No tienes nada limpio. ¡A lavar antes de empacar!")
+        return
+    packing = trip_packing(plan, items)
+    name = trip_list_name(city)
+    context.user_data["trip"] = {
+        "key": placeholder.message_id, "name": name, "description": f"{days} días en {city}", "items": packing,
+    }
+    keyboard = InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"💾 Guardar lista {name}", callback_data=f"trip:save:{placeholder.message_id}")
+    ]])
+    first, *rest = split_message(render_trip(city, forecast, plan, items, packing) + note)
+    await placeholder.edit_text(first, reply_markup=None if rest else keyboard)
+    for n, chunk in enumerate(rest, 1):
+        await placeholder.reply_text(chunk, reply_markup=keyboard if n == len(rest) else None)
+
+async def cmd_viaje(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    days_at = next((n for n, arg in enumerate(context.args) if arg.isdigit()), None)
+    if not days_at or int(context.args[days_at]) < 1:
+        await update.message.reply_text("Uso: /viaje [ciudad] [días] [plan]\nEj: /viaje CDMX 3 concierto de rock")
+        return
+    city = " ".join(context.args[:days_at])
+    await plan_trip(update, context, city, int(context.args[days_at]), " ".join(context.args[days_at + 1:]))
+
+async def on_trip_button(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """💾 under a trip plan: save its packing list, adding only what a list of
+    the same name doesn't have yet"""
+    query = update.callback_query
+    trip = context.user_data.get("trip")
+    if not trip or query.data != f"trip:save:{trip['key']}":
+        await query.answer("Ese viaje ya no lo tengo; pídelo de nuevo", show_alert=True)
+        return
+    await query.answer()
+    chat_id = update.effective_chat.id
+    name = trip["name"]
+    existing = set()
+    if not await db_create_list(chat_id, name, trip["description"]):
+        existing = {fold_text(i) for i in (await db_get_list(chat_id, name) or {}).get("items") or []}
+    new_items = [i for i in trip["items"] if fold_text(i) not in existing]
+    if new_items:
+        await db_add_list_items(chat_id, name, new_items)
+    await query.edit_message_reply_markup(reply_markup=None)
+    await query.message.reply_text(f"💾 {len(new_items)} items → {name}\nVer: /list {name}")
+
 # --- Message Handler ---
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
     text = update.message.text
 
     if context.user_data.get("awaiting_addpro"):
         context.user_data["awaiting_addpro"] = False
-        results = _parse_detailed_lines([text.strip()])
+        results, errors = await _parse_detailed_lines(chat_id, [text.strip()])
         if results:
             await update.message.reply_text(f"✅ {results[0]}")
         else:
-            await update.message.reply_text("❌ Formato incorrecto. Revisa /addpro")
+            await update.message.reply_text(f"❌ {errors[0].split(': ', 1)[-1] if errors else 'Formato incorrecto'}. Revisa /addpro")
         return
 
     if context.user_data.get("awaiting_bulk"):
         context.user_data["awaiting_bulk"] = False
         lines = text.strip().split("\n")
-        results = _parse_detailed_lines(lines)
+        results, errors = await _parse_detailed_lines(chat_id, lines)
         if results:
-            await update.message.reply_text(f"✅ {len(results)} prendas agregadas.")
+            msg = f"✅ {len(results)} prendas agregadas."
         else:
-            await update.message.reply_text("❌ No pude agregar nada. Revisa formato.")
+            msg = "❌ No pude agregar nada. Revisa formato."
+        if errors:
+            msg += "\n\n⚠️ No agregadas:\n" + "\n".join(errors[:30])
+            if len(errors) > 30:
+                msg += f"\n… y {len(errors) - 30} más"
+        await update.message.reply_text(msg)
         return
 
-    await update.message.reply_text("🤔 Checando clóset y clima...")
-    try:
-        suggestion = await get_ai_suggestion(text)
-        db_add_history(suggestion, text)
-        await update.message.reply_text(suggestion)
-    except Exception as e:
-        logger.error(f"AI error: {e}")
-        await update.message.reply_text("❌ Error. Intenta de nuevo.")
+    if is_retry_request(text) and context.user_data.get("last_request"):
+        await cmd_otra(update, context)
+        return
 
-def _parse_detailed_lines(lines):
-    results = []
-    for line in lines:
+    if is_wear_request(text):
+        await cmd_usar(update, context)
+        return
+
+    if is_laundry_done(text):
+        await change_status(update, "clean", "all")
+        return
+
+    trip = parse_trip(text)
+    if trip:
+        async with chat_lock_released():
+            await get_weather(trip[0])
+        # Somewhere wttr.in has no forecast for is an outing more often than a trip
+        if forecast_days(trip[0], 1):
+            await plan_trip(update, context, *trip)
+            return
+    await reply_outfit(update, context, text)
+
+def _parse_item_line(line):
+    """'categoría: nombre | marca: X | ...' -> (category, name, details); ValueError if invalid"""
+    if ":" not in line:
+        raise ValueError("falta 'categoría: nombre'")
+    first_split = line.split("|")
+    cat_parts = first_split[0].split(":", 1)
+    category = cat_parts[0].strip().lower()
+    name = cat_parts[1].strip()
+    if category not in ALL_CATEGORIES:
+        raise ValueError(f"categoría '{category}' no existe")
+    if not name:
+        raise ValueError("falta el nombre")
+    details = {}
+    for part in first_split[1:]:
+        if ":" in part:
+            key, val = part.split(":", 1)
+            details[key.strip().lower()] = val.strip()
+    return category, name, details
+
+async def _parse_detailed_lines(chat_id, lines):
+    """Validate every line, then insert the valid ones in bulk.
+
+    Returns (added, errors): one summary per added item and one message per
+    rejected line, numbered as the user pasted them.
+    """
+    rows, line_numbers, errors = [], [], []
+    for number, line in enumerate(lines, 1):
         line = line.strip()
-        if not line or ":" not in line:
+        if not line:
             continue
-        first_split = line.split("|")
-        cat_parts = first_split[0].split(":", 1)
-        category = cat_parts[0].strip().lower()
-        name = cat_parts[1].strip() if len(cat_parts) > 1 else ""
-        if not name or category not in ALL_CATEGORIES:
-            continue
-        details = {}
-        for part in first_split[1:]:
-            if ":" in part:
-                key, val = part.split(":", 1)
-                details[key.strip().lower()] = val.strip()
-        item = db_add_item(category, name, details)
+        try:
+            rows.append(_parse_item_line(line))
+            line_numbers.append(number)
+        except ValueError as e:
+            errors.append(f"Línea {number}: {e}")
+    results = []
+    for number, (category, name, _), (item, error) in zip(line_numbers, rows, await db_add_items(chat_id, rows)):
         if item:
             results.append(f"{name} → {category} (ID: {item['id']})")
-    return results
-
-async def send_daily_outfit(context: ContextTypes.DEFAULT_TYPE):
-    profile = db_get_profile()
-    if not profile.get("daily_enabled") or OWNER_CHAT_ID == 0:
+        else:
+            errors.append(f"Línea {number}: {error}")
+    return results, errors
+
+# --- Daily Outfit Scheduler ---
+# A planner job looks DAILY_PRECOMPUTE_WINDOW ahead and, for every chat whose
+# local DAILY_HOUR:DAILY_MINUTE falls in it, schedules a generation job at a
+# per-chat offset inside the window plus a delivery job at the exact time.
+# Generation runs through a DAILY_WORKERS pool and retries with exponential
+# backoff; the result is stored in daily_outfits so delivery is just a send.
+# A failed send is retried the same way. Runs that exhaust DAILY_MAX_ATTEMPTS
+# stay there as status 'failed' and are reported to OWNER_CHAT_ID.
+DAILY_REQUEST = "outfit para ir al trabajo hoy, casual pero presentable"
+DAILY_FAILED_TEXT = "😓 Hoy no pude preparar tu outfit diario. Pídelo con /outfit"
+_daily_runs = {}  # (chat_id, local date) -> run
+_daily_workers = asyncio.Semaphore(DAILY_WORKERS)
+
+def next_daily_delivery(profile, now):
+    """Next DAILY_HOUR:DAILY_MINUTE in the profile's timezone, strictly after now"""
+    local = now.astimezone(profile_timezone(profile))
+    deliver_at = local.replace(hour=DAILY_HOUR, minute=DAILY_MINUTE, second=0, microsecond=0)
+    if deliver_at <= local:
+        deliver_at += timedelta(days=1)
+    return deliver_at
+
+def daily_generate_at(chat_id, deliver_at):
+    """Spread generation over the window, the same slot for a chat every day"""
+    span = max(DAILY_PRECOMPUTE_WINDOW - DAILY_PRECOMPUTE_MIN_LEAD, 1)
+    offset = int(hashlib.sha1(str(chat_id).encode()).hexdigest(), 16) % span
+    return deliver_at - timedelta(seconds=DAILY_PRECOMPUTE_WINDOW - offset)
+
+def _schedule(job_queue, run, callback, when):
+    delay = max((when - datetime.now(timezone.utc)).total_seconds(), 0)
+    run["jobs"].append(job_queue.run_once(callback, delay, data=run, name=f"daily-{run['chat_id']}"))
+
+def cancel_daily_runs(chat_id):
+    """Drop planned runs for a chat (daily turned off, timezone changed)"""
+    for key, run in list(_daily_runs.items()):
+        if key[0] == chat_id and run["status"] in ("pending", "ready"):
+            run["status"] = "cancelled"
+            for job in run["jobs"]:
+                job.schedule_removal()
+            del _daily_runs[key]
+
+async def plan_daily_outfits_job(context: ContextTypes.DEFAULT_TYPE):
+    now = datetime.now(timezone.utc)
+    horizon = now + timedelta(seconds=DAILY_PRECOMPUTE_WINDOW + DAILY_PLAN_INTERVAL)
+    for key, run in list(_daily_runs.items()):
+        if run["deliver_at"] < now - timedelta(days=1):
+            del _daily_runs[key]
+    upcoming = {}
+    for profile in await db_get_profiles(daily_only=True):
+        chat_id = profile.get("chat_id")
+        if not chat_id:
+            continue
+        deliver_at = next_daily_delivery(profile, now)
+        key = (chat_id, deliver_at.date().isoformat())
+        if deliver_at <= horizon and key not in _daily_runs:
+            upcoming[key] = deliver_at
+    if not upcoming:
+        return
+    # Anything already stored (restart mid-window) is reused, not regenerated
+    stored = await db_get_daily_outfits({c for c, _ in upcoming}, {d for _, d in upcoming})
+    for (chat_id, day), deliver_at in upcoming.items():
+        row = stored.get((chat_id, day), {})
+        run = {
+            "chat_id": chat_id, "day": day, "deliver_at": deliver_at,
+            "status": row.get("status", "pending"), "outfit": row.get("outfit"),
+            "attempts": row.get("attempts", 0), "error": row.get("error"),
+            "due": False, "jobs": [],
+        }
+        _daily_runs[(chat_id, day)] = run
+        if run["status"] == "pending":
+            _schedule(context.job_queue, run, daily_generate_job, daily_generate_at(chat_id, deliver_at))
+        if run["status"] in ("pending", "ready"):
+            _schedule(context.job_queue, run, daily_deliver_job, deliver_at)
+    logger.info(f"Planned {len(upcoming)} daily outfits")
+
+async def daily_generate_job(context: ContextTypes.DEFAULT_TYPE):
+    run = context.job.data
+    if run["status"] != "pending":
         return
     try:
-        suggestion = await get_ai_suggestion("outfit para ir al trabajo hoy, casual pero presentable")
-        db_add_history(suggestion, "daily auto")
-        await context.bot.send_message(chat_id=OWNER_CHAT_ID, text=f"☀️ Buenos días! Tu outfit:\n\n{suggestion}")
+        async with _daily_workers:
+            # No chat lock: that chat's commands keep running while this waits
+            # on the LLM lane and Gemini. Earlier attempts retry Gemini (or a
+            # full lane); the last one settles for the local engine.
+            outfit = await get_ai_suggestion(
+                run["chat_id"], DAILY_REQUEST, fallback=run["attempts"] + 1 >= DAILY_MAX_ATTEMPTS
+            )
+        if not outfit:
+            raise ValueError("respuesta vacía")
     except Exception as e:
-        logger.error(f"Daily outfit error: {e}")
-
-
-# --- Main ---
-def main():
-    if not TELEGRAM_TOKEN:
-        print("❌ Falta TELEGRAM_TOKEN")
+        if run["status"] != "pending":
+            return
+        await retry_daily_run(context, run, daily_generate_job, e)
         return
-    if not GEMINI_API_KEY:
-        print("❌ Falta GEMINI_API_KEY")
+    if run["status"] != "pending":
         return
-    if not SUPABASE_URL or not SUPABASE_KEY:
-        print("❌ Falta SUPABASE_URL o SUPABASE_KEY")
+    run["outfit"] = outfit
+    run["status"] = "ready"
+    stats["daily_generated"] += 1
+    await db_save_daily_outfit(run)
+    if run["due"]:
+        await deliver_daily_outfit(context, run)
+
+async def daily_deliver_job(context: ContextTypes.DEFAULT_TYPE):
+    run = context.job.data
+    run["due"] = True
+    if run["status"] == "ready":
+        await deliver_daily_outfit(context, run)
+    elif run["status"] == "pending":
+        # Still generating or retrying; it is sent as soon as it's ready
+        stats["daily_late"] += 1
+        logger.warning(f"Daily outfit for {run['chat_id']} not ready at delivery time")
+    elif run["status"] == "failed":
+        await context.bot.send_message(chat_id=run["chat_id"], text=DAILY_FAILED_TEXT)
+
+async def retry_daily_run(context, run, callback, error):
+    """Count a failed attempt; run callback again with exponential backoff, or dead-letter the run"""
+    run["attempts"] += 1
+    run["error"] = str(error)[:500]
+    if run["attempts"] < DAILY_MAX_ATTEMPTS:
+        delay = DAILY_RETRY_BASE * 2 ** (run["attempts"] - 1)
+        stats["daily_retries"] += 1
+        logger.warning(f"Daily outfit for {run['chat_id']} failed ({error}), retry {run['attempts']} in {delay:.0f}s")
+        run["jobs"].append(context.job_queue.run_once(callback, delay, data=run, name=f"daily-{run['chat_id']}"))
+    else:
+        await dead_letter_daily_run(context.bot, run)
+
+async def deliver_daily_outfit(context, run):
+    """Send a ready run; it only counts as delivered once Telegram took it"""
+    run["status"] = "sending"
+    try:
+        await context.bot.send_message(chat_id=run["chat_id"], text=f"☀️ Buenos días! Tu outfit:\n\n{run['outfit']}")
+    except Exception as e:
+        run["status"] = "ready"
+        await retry_daily_run(context, run, daily_deliver_job, f"envío: {e}")
         return
+    run["status"] = "delivered"
+    stats["daily_delivered"] += 1
+    try:
+        await db_add_history(run["chat_id"], run["outfit"], "daily auto")
+        await db_save_daily_outfit(run)
+    except Exception as e:
+        logger.error(f"Daily outfit bookkeeping error for {run['chat_id']}: {e}")
 
-    init_db()
+async def dead_letter_daily_run(bot, run):
+    run["status"] = "failed"
+    stats["daily_failed"] += 1
+    logger.error(f"Daily outfit for {run['chat_id']} gave up after {run['attempts']} attempts: {run['error']}")
+    try:
+        await db_save_daily_outfit(run)
+        if run["due"]:
+            await bot.send_message(chat_id=run["chat_id"], text=DAILY_FAILED_TEXT)
+        if OWNER_CHAT_ID:
+            await bot.send_message(
+                chat_id=OWNER_CHAT_ID,
+                text=f"⚠️ Daily fallido: chat {run['chat_id']} ({run['day']}), {run['attempts']} intentos\n{run['error']}",
+            )
+    except Exception as e:
+        logger.error(f"Dead-letter report error for {run['chat_id']}: {e}")
 
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+
+# --- Main ---
+async def on_startup(app: Application):
+    with stage("startup_clients"):
+        await init_clients()
+        start_journal()
+    # Updates can be handled already; the warm-up just saves the first ones a connect
+    spawn(warm_up_clients())
+
+async def on_shutdown(app: Application):
+    await close_clients()
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
+    stats["errors"] += 1
+    logger.error(f"Error handling {update_kind(update)}: {context.error!r}", exc_info=context.error)
+
+def build_application(token, request=None, updater=True) -> Application:
+    """Application with every handler and job registered; request swaps the Telegram
+    transport, updater=False leaves fetching updates to serve_webhook"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(TimedRequest(request or HTTPXRequest(connection_pool_size=256)))
+        .concurrent_updates(ChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    if not updater:
+        builder = builder.updater(None)
+    app = builder.build()
+    app.add_error_handler(on_error)
 
     app.add_handler(CommandHandler("start", cmd_start))
     app.add_handler(CommandHandler("outfit", cmd_outfit))
+    app.add_handler(CommandHandler("otra", cmd_otra))
     app.add_handler(CommandHandler("add", cmd_add))
     app.add_handler(CommandHandler("addpro", cmd_addpro))
     app.add_handler(CommandHandler("bulk", cmd_bulk))
@@ -715,6 +3557,11 @@ def main():
     app.add_handler(CommandHandler("where", cmd_where))
     app.add_handler(CommandHandler("closet", cmd_closet))
     app.add_handler(CommandHandler("available", cmd_available))
+    app.add_handler(CallbackQueryHandler(on_closet_button, pattern=r"^closet:"))
+    app.add_handler(CallbackQueryHandler(on_trip_button, pattern=r"^trip:"))
+    app.add_handler(CommandHandler("usar", cmd_usar))
+    app.add_handler(CommandHandler("viaje", cmd_viaje))
+    app.add_handler(CommandHandler("rotacion", cmd_rotacion))
     app.add_handler(CommandHandler("feedback", cmd_feedback))
     app.add_handler(CommandHandler("daily", cmd_daily))
     app.add_handler(CommandHandler("city", cmd_city))
@@ -723,30 +3570,105 @@ def main():
     app.add_handler(CommandHandler("list", cmd_list))
     app.add_handler(CommandHandler("listadd", cmd_listadd))
     app.add_handler(CommandHandler("listdel", cmd_listdel))
+    app.add_handler(CommandHandler("listmove", cmd_listmove))
     app.add_handler(CommandHandler("listnew", cmd_listnew))
     app.add_handler(CommandHandler("listremove", cmd_listremove))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
 
-    from datetime import timezone, timedelta
-    tz = timezone(timedelta(hours=TIMEZONE_OFFSET))
-    job_time = time(hour=DAILY_HOUR, minute=DAILY_MINUTE, tzinfo=tz)
-    app.job_queue.run_daily(send_daily_outfit, time=job_time)
+    app.job_queue.run_repeating(plan_daily_outfits_job, interval=DAILY_PLAN_INTERVAL, first=0)
+    app.job_queue.run_repeating(warm_weather_job, interval=WEATHER_REFRESH_INTERVAL, first=0)
+    app.job_queue.run_repeating(reconcile_wardrobe_job, interval=WARDROBE_RECONCILE_INTERVAL, first=WARDROBE_RECONCILE_INTERVAL)
+
+    return app
+
+# --- Webhook Server ---
+# Our own tornado app instead of run_webhook's, so /metrics is served on the
+# same port as /webhook. Updates go straight onto the Application's queue.
+# The port is bound first thing: on a host that scales to zero the request
+# that woke us is acknowledged at once and waits on the queue while the bot
+# and its clients initialize.
+class WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, app):
+        self.app = app
+
+    async def post(self):
+        received = perf_counter()
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except ValueError:
+            stats["webhook_bad_requests"] += 1
+            self.set_status(400)
+            return
+        _received_at[update.update_id] = received
+        stats["webhook_updates"] += 1
+        await self.app.update_queue.put(update)
+
+class MetricsHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4")
+        self.write(render_metrics())
+
+async def ensure_webhook(app: Application, webhook_url):
+    """Register the webhook unless Telegram already has it. A restart after
+    scaling to zero keeps the updates Telegram queued meanwhile."""
+    try:
+        info = await app.bot.get_webhook_info()
+        if info.url != webhook_url:
+            await app.bot.set_webhook(webhook_url, drop_pending_updates=True)
+            logger.info(f"Webhook set to {webhook_url}")
+    except Exception as e:
+        logger.error(f"Webhook registration error: {e!r}")
+
+async def serve_webhook(app: Application, port, webhook_url):
+    """What run_webhook does, with /metrics next to /webhook; runs until SIGINT/SIGTERM"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    server = tornado.web.Application([
+        (r"/webhook", WebhookHandler, {"app": app}),
+        (r"/metrics", MetricsHandler),
+    ]).listen(port, "0.0.0.0")
+    observe("stage_seconds", perf_counter() - STARTED_AT, stage="startup_listen")
+    with stage("startup_initialize"):
+        await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.start()
+    observe("stage_seconds", perf_counter() - STARTED_AT, stage="startup_ready")
+    logger.info(f"Listening on :{port}, ready {(perf_counter() - STARTED_AT) * 1000:.0f}ms after import")
+    spawn(ensure_webhook(app, webhook_url))
+    try:
+        await stop.wait()
+    finally:
+        server.stop()
+        await app.stop()
+        await app.shutdown()
+        if app.post_shutdown:
+            await app.post_shutdown(app)
+
+def main():
+    if not TELEGRAM_TOKEN:
+        print("❌ Falta TELEGRAM_TOKEN")
+        return
+    if not GEMINI_API_KEY:
+        print("❌ Falta GEMINI_API_KEY")
+        return
+    if not SUPABASE_URL or not SUPABASE_KEY:
+        print("❌ Falta SUPABASE_URL o SUPABASE_KEY")
+        return
 
     RENDER_URL = os.getenv("RENDER_EXTERNAL_URL")
     WEBHOOK_URL = os.getenv("WEBHOOK_URL")
     PORT = int(os.getenv("PORT", "10000"))
     webhook_base = WEBHOOK_URL or RENDER_URL
 
+    app = build_application(TELEGRAM_TOKEN, updater=not webhook_base)
+
     if webhook_base:
         webhook_full = f"{webhook_base}/webhook"
-        print(f"🤖 Outfit Bot (Supabase + webhook: {webhook_full})")
-        app.run_webhook(
-            listen="0.0.0.0",
-            port=PORT,
-            url_path="/webhook",
-            webhook_url=webhook_full,
-            drop_pending_updates=True,
-        )
+        print(f"🤖 Outfit Bot (Supabase + webhook: {webhook_full}, métricas en /metrics)")
+        asyncio.run(serve_webhook(app, PORT, webhook_full))
     else:
         print("🤖 Outfit Bot (Supabase + polling local)")
         app.run_polling(drop_pending_updates=True)
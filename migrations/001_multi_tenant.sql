@@ -0,0 +1,23 @@
+-- Scope every table to a Telegram chat so one deployment can serve many users.
+-- Rows created before this migration keep chat_id NULL; on startup the bot
+-- assigns them to OWNER_CHAT_ID (see adopt_legacy_rows in bot.py).
+
+alter table profile add column if not exists chat_id bigint;
+alter table items add column if not exists chat_id bigint;
+alter table outfit_history add column if not exists chat_id bigint;
+alter table feedback add column if not exists chat_id bigint;
+alter table packing_lists add column if not exists chat_id bigint;
+
+-- profile used to be a single row with id = 1; new rows need a generated id
+create sequence if not exists profile_id_seq owned by profile.id;
+select setval('profile_id_seq', greatest((select max(id) from profile), 1));
+alter table profile alter column id set default nextval('profile_id_seq');
+create unique index if not exists profile_chat_id_key on profile (chat_id);
+
+create index if not exists items_chat_id_idx on items (chat_id, category, id);
+create index if not exists outfit_history_chat_id_idx on outfit_history (chat_id, created_at desc);
+create index if not exists feedback_chat_id_idx on feedback (chat_id, created_at desc);
+
+-- List names are unique per chat, not globally
+alter table packing_lists drop constraint if exists packing_lists_name_key;
+create unique index if not exists packing_lists_chat_id_name_key on packing_lists (chat_id, name);
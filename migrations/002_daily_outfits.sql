@@ -0,0 +1,20 @@
+-- Per-user timezone for the daily outfit (IANA name, e.g. America/Monterrey).
+-- Profiles without one fall back to TIMEZONE_OFFSET.
+alter table profile add column if not exists timezone text;
+
+-- Daily outfits generated ahead of delivery time. One row per chat and local
+-- date; status is ready -> delivered, or failed once retries run out (those
+-- rows are the dead-letter list: attempts and the last error are kept).
+create table if not exists daily_outfits (
+    id bigint generated by default as identity primary key,
+    chat_id bigint not null,
+    day date not null,
+    outfit text,
+    status text not null default 'pending',
+    attempts int not null default 0,
+    error text,
+    created_at timestamptz not null default now(),
+    unique (chat_id, day)
+);
+
+create index if not exists daily_outfits_failed_idx on daily_outfits (day) where status = 'failed';
@@ -0,0 +1,64 @@
+-- Single-statement packing-list edits. Each function locks the list row,
+-- changes its items array and returns the result, so concurrent edits from
+-- the bot can't overwrite each other and every edit is one round-trip.
+-- All return NULL when the list doesn't exist.
+
+-- Append p_items (a JSON array of strings) to the list
+create or replace function list_add_items(p_chat_id bigint, p_name text, p_items jsonb)
+returns jsonb language sql as $$
+    update packing_lists
+    set items = coalesce(items, '[]'::jsonb) || p_items
+    where chat_id = p_chat_id and name = p_name
+    returning items;
+$$;
+
+-- Remove the items at the given 1-based positions: {"items": [...], "removed": [...]}
+create or replace function list_remove_items(p_chat_id bigint, p_name text, p_positions int[])
+returns jsonb language plpgsql as $$
+declare
+    v_items jsonb;
+    v_kept jsonb;
+    v_removed jsonb;
+begin
+    select coalesce(items, '[]'::jsonb) into v_items
+    from packing_lists where chat_id = p_chat_id and name = p_name
+    for update;
+    if not found then
+        return null;
+    end if;
+    select coalesce(jsonb_agg(e order by i) filter (where i <> all(p_positions)), '[]'::jsonb),
+           coalesce(jsonb_agg(e order by i) filter (where i = any(p_positions)), '[]'::jsonb)
+    into v_kept, v_removed
+    from jsonb_array_elements(v_items) with ordinality as t(e, i);
+    update packing_lists set items = v_kept where chat_id = p_chat_id and name = p_name;
+    return jsonb_build_object('items', v_kept, 'removed', v_removed);
+end;
+$$;
+
+-- Move the item at p_from to p_to (1-based): {"items": [...], "moved": item}
+create or replace function list_move_item(p_chat_id bigint, p_name text, p_from int, p_to int)
+returns jsonb language plpgsql as $$
+declare
+    v_items jsonb;
+    v_item jsonb;
+begin
+    select coalesce(items, '[]'::jsonb) into v_items
+    from packing_lists where chat_id = p_chat_id and name = p_name
+    for update;
+    if not found then
+        return null;
+    end if;
+    if p_from < 1 or p_from > jsonb_array_length(v_items) then
+        return jsonb_build_object('items', v_items, 'moved', null);
+    end if;
+    v_item := v_items -> (p_from - 1);
+    v_items := v_items - (p_from - 1);
+    if p_to > jsonb_array_length(v_items) then
+        v_items := v_items || jsonb_build_array(v_item);
+    else
+        v_items := jsonb_insert(v_items, array[(greatest(p_to, 1) - 1)::text], v_item);
+    end if;
+    update packing_lists set items = v_items where chat_id = p_chat_id and name = p_name;
+    return jsonb_build_object('items', v_items, 'moved', v_item);
+end;
+$$;
@@ -0,0 +1,6 @@
+-- Writes replayed from the bot's local journal carry a client-generated key;
+-- inserts use it as the conflict target so a replay never duplicates a row.
+alter table outfit_history add column if not exists idempotency_key text;
+alter table feedback add column if not exists idempotency_key text;
+create unique index if not exists outfit_history_idempotency_key on outfit_history (idempotency_key);
+create unique index if not exists feedback_idempotency_key on feedback (idempotency_key);
@@ -0,0 +1,40 @@
+-- Which wardrobe items each saved suggestion used, one row per item. The bot
+-- reads the "[id]" on each garment line of the answer and journals these rows
+-- right after the outfit_history row, keyed by its idempotency_key.
+create table if not exists outfit_history_items (
+    chat_id bigint not null,
+    history_key text not null references outfit_history (idempotency_key) on delete cascade,
+    item_id bigint not null references items (id) on delete cascade,
+    slot text,
+    created_at timestamptz not null default now(),
+    primary key (history_key, item_id)
+);
+
+create index if not exists outfit_history_items_item_idx on outfit_history_items (chat_id, item_id);
+
+-- Set once the user says they wore the suggestion (/usar)
+alter table outfit_history add column if not exists worn_on date;
+
+-- Count a suggestion as worn on p_day: one update bumps times_worn and
+-- last_worn for all its items. Idempotent, so a replayed call from the
+-- journal doesn't count twice. Returns how many items were bumped.
+create or replace function wear_outfit(p_chat_id bigint, p_history_key text, p_day date)
+returns int language plpgsql as $$
+declare
+    v_count int;
+begin
+    update outfit_history set worn_on = p_day
+    where chat_id = p_chat_id and idempotency_key = p_history_key and worn_on is null;
+    if not found then
+        return 0;
+    end if;
+    update items i
+    set times_worn = coalesce(i.times_worn, 0) + 1,
+        last_worn = p_day
+    from outfit_history_items h
+    where h.history_key = p_history_key and h.chat_id = p_chat_id
+      and i.id = h.item_id and i.chat_id = p_chat_id;
+    get diagnostics v_count = row_count;
+    return v_count;
+end;
+$$;
@@ -0,0 +1,18 @@
+-- Move many items to a new status in one statement (/clean all, /dirty 3 7 12,
+-- "laundry done"). A reason is merged into details as status_reason on the
+-- server, so the bot doesn't send each row's details back. Returns how many
+-- items changed.
+create or replace function set_item_status(p_chat_id bigint, p_ids bigint[], p_status text, p_reason text default null)
+returns int language sql as $$
+    with changed as (
+        update items
+        set status = p_status,
+            details = case
+                when p_reason is null then details
+                else coalesce(details, '{}'::jsonb) || jsonb_build_object('status_reason', p_reason)
+            end
+        where chat_id = p_chat_id and id = any(p_ids)
+        returning 1
+    )
+    select count(*)::int from changed;
+$$;